@@ -6,26 +6,41 @@ LICENSE: PROPRIETARY
 """
 
 import os
+import sys
 import json
+import csv
+import io
+import codecs
 import time
 import threading
 import html
 import hashlib
+import hmac
 import requests
 import re
 import shlex
 import sqlite3
 import logging
-from typing import Any, Dict, List
-from collections import defaultdict
+import queue
+import atexit
+import tracemalloc
+import contextvars
+from contextlib import contextmanager
+import random
+import heapq
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+from urllib.parse import quote
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta, timezone
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 # Import Libraries
 try:
-    from fastapi import FastAPI, Request, HTTPException, Depends, status, Form, Cookie, File, UploadFile
-    from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse, JSONResponse
+    from fastapi import FastAPI, Request, HTTPException, Depends, status, Form, Cookie, File, UploadFile, Body, Header
+    from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
     from fastapi.security import APIKeyCookie
+    from fastapi.concurrency import run_in_threadpool
     from dotenv import load_dotenv
     load_dotenv()
 except ImportError:
@@ -41,11 +56,30 @@ class SystemConfig:
     VERSION = "35.0.0"
     DATABASE_FILE = "galaxy_data.db"
     LOG_FILE = "system_run.log"
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+    LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json | text
+    LOG_QUEUE_SIZE = 10000
+    LOG_BURST = int(os.getenv("LOG_BURST", "5"))          # số log / key / cửa sổ trước khi bị sampling
+    LOG_WINDOW = int(os.getenv("LOG_WINDOW", "60"))
+    LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", "50"))
     ADMIN_SECRET = os.getenv("ADMIN_SECRET", "admin").strip()
     BACKUP_DIR = os.getenv("BACKUP_DIR", "") 
     DEFAULT_POLL_INTERVAL = 10
     VERIFY_TLS = bool(int(os.getenv("VERIFY_TLS", "1")))
     DISABLE_POLLER = os.getenv("DISABLE_POLLER", "0") == "1"
+    # Timeout policy cho request tới TapHoa
+    CONNECT_TIMEOUT = float(os.getenv("CONNECT_TIMEOUT", "5"))
+    READ_TIMEOUT = float(os.getenv("READ_TIMEOUT", "20"))
+    TICK_BUDGET = float(os.getenv("TICK_BUDGET", "60"))   # cả 1 lượt poll (mọi shop)
+    SHOP_BUDGET = float(os.getenv("SHOP_BUDGET", "8"))    # trần cho 1 shop trong lượt đó
+    MAX_RETRIES = int(os.getenv("MAX_RETRIES", "2"))
+    RETRY_BACKOFF = float(os.getenv("RETRY_BACKOFF", "0.5"))
+    HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "0") == "1"
+    HEDGE_MIN_SAMPLES = 20
+    # Webhook push (/taphoammo)
+    WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+    PUSH_WINDOW = int(os.getenv("PUSH_WINDOW", "3600"))
+    WEBHOOK_MAX_BATCH = 200
 
 # TIMEZONE VIETNAM (UTC+7)
 VN_TZ = timezone(timedelta(hours=7))
@@ -57,7 +91,39 @@ def get_vn_time():
 # 2. DATABASE & LOGGING
 # ==============================================================================
 
+LOG_CTX = contextvars.ContextVar("log_ctx", default={})
+
+class JsonLogFormatter(logging.Formatter):
+    # Chạy trên thread listener, không nằm trên luồng poller
+    def format(self, record):
+        data = {"ts": datetime.fromtimestamp(record.created, VN_TZ).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3],
+                "level": record.levelname, "thread": record.threadName, "msg": record.getMessage()}
+        data.update(getattr(record, "ctx", {}))
+        data.update(getattr(record, "fields", {}))
+        if record.exc_info: data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class TextLogFormatter(logging.Formatter):
+    def format(self, record):
+        extra = {**getattr(record, "ctx", {}), **getattr(record, "fields", {})}
+        tail = " " + " ".join(f"{k}={v}" for k, v in extra.items()) if extra else ""
+        ts = datetime.fromtimestamp(record.created, VN_TZ).strftime("%Y-%m-%d %H:%M:%S")
+        return f"{ts} [{record.levelname}] {record.getMessage()}{tail}"
+
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+    def prepare(self, record):
+        # Không format trên luồng gọi; chỉ gộp args để record an toàn khi qua thread khác
+        record.msg = record.getMessage(); record.args = None
+        return record
+    def enqueue(self, record):
+        try: self.queue.put_nowait(record)
+        except queue.Full: self.dropped += 1
+
 class LoggerManager:
+    """Log bất đồng bộ qua queue: luồng gọi chỉ put_nowait, file/stdout ghi trên thread listener."""
     _instance = None
     def __new__(cls):
         if cls._instance is None:
@@ -66,18 +132,66 @@ class LoggerManager:
         return cls._instance
     def _setup(self):
         self.logger = logging.getLogger("GalaxyBot")
-        self.logger.setLevel(logging.INFO)
-        formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-        formatter.converter = lambda *args: get_vn_time().timetuple()
-        
+        self.logger.setLevel(getattr(logging, SystemConfig.LOG_LEVEL, logging.INFO))
+        self.logger.propagate = False
+        formatter = JsonLogFormatter() if SystemConfig.LOG_FORMAT == "json" else TextLogFormatter()
+
         file_handler = RotatingFileHandler(SystemConfig.LOG_FILE, maxBytes=5*1024*1024, backupCount=3)
         file_handler.setFormatter(formatter)
-        self.logger.addHandler(file_handler)
         console_handler = logging.StreamHandler()
         console_handler.setFormatter(formatter)
-        self.logger.addHandler(console_handler)
-    def info(self, msg): self.logger.info(msg)
-    def error(self, msg): self.logger.error(msg)
+        self.queue_handler = DroppingQueueHandler(queue.Queue(SystemConfig.LOG_QUEUE_SIZE))
+        self.logger.addHandler(self.queue_handler)
+        self.listener = QueueListener(self.queue_handler.queue, file_handler, console_handler, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+
+        self.rate_lock = threading.Lock()
+        self.rate = {}  # key -> [window_start, count, suppressed]
+
+    def _allow(self, key):
+        """Rate limit + sampling theo key. Trả về (có log không, số log đã bị nuốt)."""
+        now = time.monotonic()
+        with self.rate_lock:
+            st = self.rate.get(key)
+            if st is None or now - st[0] >= SystemConfig.LOG_WINDOW:
+                suppressed = st[2] if st else 0
+                self.rate[key] = [now, 1, 0]
+                if len(self.rate) > 5000: self.rate = {k: v for k, v in self.rate.items() if now - v[0] < SystemConfig.LOG_WINDOW}
+                return True, suppressed
+            st[1] += 1
+            if st[1] <= SystemConfig.LOG_BURST or (st[1] - SystemConfig.LOG_BURST) % SystemConfig.LOG_SAMPLE_EVERY == 0:
+                suppressed, st[2] = st[2], 0
+                return True, suppressed
+            st[2] += 1
+            return False, 0
+
+    def log(self, level, msg, key=None, **fields):
+        if not self.logger.isEnabledFor(level): return
+        if key is not None:
+            allowed, suppressed = self._allow(key)
+            if not allowed: return
+            if suppressed: fields["suppressed"] = suppressed
+        self.logger.log(level, msg, extra={"ctx": LOG_CTX.get(), "fields": fields})
+
+    def debug(self, msg, key=None, **fields): self.log(logging.DEBUG, msg, key, **fields)
+    def info(self, msg, key=None, **fields): self.log(logging.INFO, msg, key, **fields)
+    def warning(self, msg, key=None, **fields): self.log(logging.WARNING, msg, key, **fields)
+    def error(self, msg, key=None, **fields): self.log(logging.ERROR, msg, key, **fields)
+
+    @contextmanager
+    def context(self, **ctx):
+        token = LOG_CTX.set({**LOG_CTX.get(), **ctx})
+        try: yield
+        finally: LOG_CTX.reset(token)
+
+    def get_level(self) -> str: return logging.getLevelName(self.logger.level)
+    def set_level(self, level: str):
+        lvl = logging.getLevelName(str(level).upper())
+        if not isinstance(lvl, int): raise ValueError(f"Log level không hợp lệ: {level}")
+        self.logger.setLevel(lvl)
+    def status(self) -> Dict[str, Any]:
+        return {"level": self.get_level(), "queued": self.queue_handler.queue.qsize(), "dropped": self.queue_handler.dropped}
 
 SYS_LOG = LoggerManager()
 
@@ -91,9 +205,18 @@ class DatabaseManager:
         return conn
     def init_db(self):
         conn = self.get_connection()
+        # WAL: request đọc không phải chờ poller / handler đang ghi
+        conn.execute('PRAGMA journal_mode=WAL')
         conn.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)')
         conn.execute('CREATE TABLE IF NOT EXISTS accounts (id TEXT PRIMARY KEY, name TEXT, bot_token TEXT, notify_curl TEXT, chat_curl TEXT, created_at DATETIME DEFAULT CURRENT_TIMESTAMP)')
         conn.execute('CREATE TABLE IF NOT EXISTS stats (id INTEGER PRIMARY KEY AUTOINCREMENT, account_id TEXT, date TEXT, category TEXT, count INTEGER DEFAULT 0, UNIQUE(account_id, date, category))')
+        acc_cols = {r['name'] for r in conn.execute("PRAGMA table_info(accounts)").fetchall()}
+        for col in ("chat_id", "mute_window"):
+            if col not in acc_cols: conn.execute(f"ALTER TABLE accounts ADD COLUMN {col} TEXT DEFAULT ''")
+        conn.execute('CREATE TABLE IF NOT EXISTS cookie_jars (account_id TEXT NOT NULL, name TEXT NOT NULL, value TEXT, expires INTEGER, updated_at INTEGER, PRIMARY KEY (account_id, name)) WITHOUT ROWID')
+        conn.execute('CREATE TABLE IF NOT EXISTS cookie_seeds (account_id TEXT PRIMARY KEY, seed_hash TEXT, seeded_at INTEGER, refreshed_at INTEGER)')
+        conn.execute('CREATE TABLE IF NOT EXISTS webhook_orders (order_id TEXT PRIMARY KEY, account_id TEXT, received_at INTEGER NOT NULL) WITHOUT ROWID')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_webhook_orders_received ON webhook_orders (received_at)')
         conn.commit()
         conn.close()
 
@@ -104,25 +227,159 @@ class DatabaseManager:
     def set_setting(self, key, value):
         with self.get_connection() as conn:
             conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
+    def set_settings(self, values: Dict[str, Any]):
+        with self.get_connection() as conn:
+            conn.executemany("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", [(k, str(v)) for k, v in values.items()])
+    def get_settings(self, *keys):
+        with self.get_connection() as conn:
+            rows = conn.execute(f"SELECT key, value FROM settings WHERE key IN ({','.join('?' * len(keys))})", keys).fetchall()
+            return {r['key']: r['value'] for r in rows}
     def get_all_accounts(self):
         with self.get_connection() as conn:
             return [dict(row) for row in conn.execute("SELECT * FROM accounts").fetchall()]
+    def count_accounts(self):
+        with self.get_connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM accounts").fetchone()[0]
+    def list_accounts(self, query="", offset=0, limit=50):
+        # Chỉ trả các trường tóm tắt, không kéo notify_curl / chat_curl (chứa cookie) ra khỏi DB
+        where, params = "", []
+        if query:
+            where = "WHERE name LIKE ? ESCAPE '\\' OR id = ?"
+            params = ["%" + re.sub(r"([%_\\])", r"\\\1", query) + "%", query]
+        with self.get_connection() as conn:
+            total = conn.execute(f"SELECT COUNT(*) FROM accounts {where}", params).fetchone()[0]
+            rows = conn.execute(f"""SELECT id, name, chat_id, mute_window, created_at,
+                COALESCE(notify_curl, '') != '' AS has_notify, COALESCE(chat_curl, '') != '' AS has_chat, COALESCE(bot_token, '') != '' AS has_token
+                FROM accounts {where} ORDER BY name COLLATE NOCASE, id LIMIT ? OFFSET ?""", params + [limit, offset]).fetchall()
+            return total, [dict(r) for r in rows]
+    def get_account(self, acc_id):
+        with self.get_connection() as conn:
+            row = conn.execute("SELECT * FROM accounts WHERE id = ?", (acc_id,)).fetchone()
+            return dict(row) if row else None
     def save_account(self, acc_id, data):
         with self.get_connection() as conn:
-            conn.execute('INSERT OR REPLACE INTO accounts (id, name, bot_token, notify_curl, chat_curl) VALUES (?, ?, ?, ?, ?)', 
-                         (acc_id, data['account_name'], data['bot_token'], data['notify_curl'], data['chat_curl']))
+            conn.execute('INSERT OR REPLACE INTO accounts (id, name, bot_token, notify_curl, chat_curl, chat_id, mute_window) VALUES (?, ?, ?, ?, ?, ?, ?)', 
+                         (acc_id, data['account_name'], data['bot_token'], data['notify_curl'], data['chat_curl'], data.get('chat_id', ''), data.get('mute_window', '')))
     def delete_account(self, acc_id):
         with self.get_connection() as conn:
             conn.execute("DELETE FROM accounts WHERE id = ?", (acc_id,))
+            conn.execute("DELETE FROM cookie_jars WHERE account_id = ?", (acc_id,))
+            conn.execute("DELETE FROM cookie_seeds WHERE account_id = ?", (acc_id,))
+            conn.execute("DELETE FROM settings WHERE key = ?", (f"chat_cursor:{acc_id}",))
+    def replace_accounts(self, accounts: Dict[str, dict]):
+        # Đồng bộ toàn bộ danh sách shop trong 1 transaction: xoá shop không còn, upsert phần còn lại
+        with self.get_connection() as conn:
+            keep = set(accounts.keys())
+            gone = [r['id'] for r in conn.execute("SELECT id FROM accounts").fetchall() if r['id'] not in keep]
+            for table, col in (("accounts", "id"), ("cookie_jars", "account_id"), ("cookie_seeds", "account_id")):
+                conn.executemany(f"DELETE FROM {table} WHERE {col} = ?", [(aid,) for aid in gone])
+            conn.executemany("DELETE FROM settings WHERE key = ?", [(f"chat_cursor:{aid}",) for aid in gone])
+            conn.executemany('INSERT OR REPLACE INTO accounts (id, name, bot_token, notify_curl, chat_curl, chat_id, mute_window) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             [(aid, d['account_name'], d['bot_token'], d['notify_curl'], d['chat_curl'], d.get('chat_id', ''), d.get('mute_window', '')) for aid, d in accounts.items()])
+    def load_cookie_jar(self, acc_id, seed_hash):
+        # cURL mới (seed khác) -> bỏ cookie đã refresh của phiên cũ
+        now = int(time.time())
+        with self.get_connection() as conn:
+            seed = conn.execute("SELECT seed_hash, seeded_at, refreshed_at FROM cookie_seeds WHERE account_id = ?", (acc_id,)).fetchone()
+            if not seed or seed['seed_hash'] != seed_hash:
+                conn.execute("DELETE FROM cookie_jars WHERE account_id = ?", (acc_id,))
+                conn.execute("INSERT OR REPLACE INTO cookie_seeds (account_id, seed_hash, seeded_at, refreshed_at) VALUES (?, ?, ?, NULL)", (acc_id, seed_hash, now))
+                return [], now, None
+            rows = conn.execute("SELECT name, value, expires FROM cookie_jars WHERE account_id = ?", (acc_id,)).fetchall()
+            return [dict(r) for r in rows], seed['seeded_at'], seed['refreshed_at']
+    def save_cookies(self, acc_id, upserts, deletes):
+        now = int(time.time())
+        with self.get_connection() as conn:
+            conn.executemany("INSERT OR REPLACE INTO cookie_jars (account_id, name, value, expires, updated_at) VALUES (?, ?, ?, ?, ?)",
+                             [(acc_id, name, c['value'], c['expires'], now) for name, c in upserts.items()])
+            conn.executemany("INSERT OR REPLACE INTO cookie_jars (account_id, name, value, expires, updated_at) VALUES (?, ?, '', 0, ?)", [(acc_id, name, now) for name in deletes])
+            conn.execute("UPDATE cookie_seeds SET refreshed_at = ? WHERE account_id = ?", (now, acc_id))
     def update_stat(self, acc_id, date, category, amount):
         with self.get_connection() as conn:
             # Category: 'order' (Đơn hàng), 'msg' (Tin nhắn), 'other'
             row = conn.execute("SELECT count FROM stats WHERE account_id=? AND date=? AND category=?", (acc_id, date, category)).fetchone()
             if row: conn.execute("UPDATE stats SET count=? WHERE account_id=? AND date=? AND category=?", (row['count'] + amount, acc_id, date, category))
             else: conn.execute("INSERT INTO stats (account_id, date, category, count) VALUES (?, ?, ?, ?)", (acc_id, date, category, amount))
+    def claim_order(self, order_id, acc_id) -> bool:
+        # Idempotency: chỉ lần đầu thấy order_id mới trả True
+        with self.get_connection() as conn:
+            return conn.execute("INSERT OR IGNORE INTO webhook_orders (order_id, account_id, received_at) VALUES (?, ?, ?)", (order_id, acc_id, int(time.time()))).rowcount == 1
+    def prune_orders(self, before_ts):
+        with self.get_connection() as conn:
+            return conn.execute("DELETE FROM webhook_orders WHERE received_at < ?", (before_ts,)).rowcount
 
 DB = DatabaseManager(SystemConfig.DATABASE_FILE)
 
+class EventStore:
+    """Log append-only từng thay đổi counter / tin nhắn, gộp dần thành rollup giờ -> ngày."""
+    STATUS = {"baseline": 0, "sent": 1, "failed": 2, "skipped": 3, "muted": 4}
+    STATUS_NAME = {v: k for k, v in STATUS.items()}
+    RAW_DAYS = int(os.getenv("EVENT_RAW_DAYS", "7"))
+    HOURLY_DAYS = int(os.getenv("EVENT_HOURLY_DAYS", "90"))
+    DAILY_DAYS = int(os.getenv("EVENT_DAILY_DAYS", "730"))
+    VACUUM_EVERY = 7 * 86400
+    TZ_OFFSET = int(VN_TZ.utcoffset(None).total_seconds())  # bucket ngày theo nửa đêm giờ VN, khớp bảng stats
+
+    def __init__(self, db: DatabaseManager):
+        self.db = db
+        with self.db.get_connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, ts INTEGER NOT NULL, account_id TEXT NOT NULL, category TEXT NOT NULL, delta INTEGER NOT NULL, status INTEGER NOT NULL DEFAULT 0)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_events_ts ON events (ts)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_events_acc_ts ON events (account_id, ts)')
+            conn.execute('CREATE TABLE IF NOT EXISTS event_rollups (bucket INTEGER NOT NULL, span INTEGER NOT NULL, account_id TEXT NOT NULL, category TEXT NOT NULL, total INTEGER NOT NULL, events INTEGER NOT NULL, PRIMARY KEY (span, account_id, category, bucket)) WITHOUT ROWID')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_rollups_bucket ON event_rollups (span, bucket)')
+
+    def record(self, acc_id, items, status="sent"):
+        # items: [(category, delta), ...]
+        if not items: return
+        ts = int(time.time())
+        code = self.STATUS.get(status, 0)
+        try:
+            with self.db.get_connection() as conn:
+                conn.executemany("INSERT INTO events (ts, account_id, category, delta, status) VALUES (?, ?, ?, ?, ?)",
+                                 [(ts, acc_id, cat, int(delta), code) for cat, delta in items])
+        except Exception as e: SYS_LOG.error(f"❌ Event log failed: {e}")
+
+    def query(self, start_ts, end_ts, account_id=None, span=0, limit=5000):
+        """span=0: event thô; 3600 / 86400: rollup theo giờ / ngày."""
+        params = [start_ts, end_ts]
+        acc_sql = ""
+        if account_id: acc_sql = " AND account_id = ?"; params.append(account_id)
+        params.append(limit)
+        with self.db.get_connection() as conn:
+            if span == 0:
+                rows = conn.execute(f"SELECT ts, account_id, category, delta, status FROM events WHERE ts >= ? AND ts < ?{acc_sql} ORDER BY ts LIMIT ?", params).fetchall()
+                return [{**dict(r), "status": self.STATUS_NAME.get(r['status'], "unknown")} for r in rows]
+            rows = conn.execute(f"SELECT bucket AS ts, account_id, category, total, events FROM event_rollups WHERE span = ? AND bucket >= ? AND bucket < ?{acc_sql} ORDER BY bucket LIMIT ?", [span] + params).fetchall()
+            return [dict(r) for r in rows]
+
+    def _rollup(self, conn, src_sql, span, cutoff):
+        conn.execute(f"""INSERT INTO event_rollups (bucket, span, account_id, category, total, events)
+            SELECT ((ts + {self.TZ_OFFSET}) / {span}) * {span} - {self.TZ_OFFSET}, {span}, account_id, category, SUM(delta), SUM(n) FROM ({src_sql}) WHERE ts < ? GROUP BY 1, 3, 4
+            ON CONFLICT (span, account_id, category, bucket) DO UPDATE SET total = total + excluded.total, events = events + excluded.events""", (cutoff,))
+
+    def compact(self):
+        now = int(time.time())
+        raw_cut = (now - self.RAW_DAYS * 86400) // 3600 * 3600
+        hourly_cut = (now - self.HOURLY_DAYS * 86400 + self.TZ_OFFSET) // 86400 * 86400 - self.TZ_OFFSET
+        daily_cut = now - self.DAILY_DAYS * 86400
+        with self.db.get_connection() as conn:
+            self._rollup(conn, "SELECT ts, account_id, category, delta, 1 AS n FROM events", 3600, raw_cut)
+            raw = conn.execute("DELETE FROM events WHERE ts < ?", (raw_cut,)).rowcount
+            self._rollup(conn, "SELECT bucket AS ts, account_id, category, total AS delta, events AS n FROM event_rollups WHERE span = 3600", 86400, hourly_cut)
+            hourly = conn.execute("DELETE FROM event_rollups WHERE span = 3600 AND bucket < ?", (hourly_cut,)).rowcount
+            daily = conn.execute("DELETE FROM event_rollups WHERE span = 86400 AND bucket < ?", (daily_cut,)).rowcount
+        self.db.prune_orders(raw_cut)
+        if raw or hourly or daily: SYS_LOG.info(f"🧹 Compact events: {raw} raw, {hourly} hourly, {daily} daily")
+        last_vacuum = int(self.db.get_setting("events_last_vacuum", "0"))
+        if now - last_vacuum >= self.VACUUM_EVERY:
+            conn = self.db.get_connection()
+            try: conn.execute("VACUUM")
+            finally: conn.close()
+            self.db.set_setting("events_last_vacuum", now)
+
+EVENTS = EventStore(DB)
+
 # ==============================================================================
 # 3. BACKUP MANAGER
 # ==============================================================================
@@ -141,6 +398,7 @@ class BackupManager:
         for acc in accounts:
             data["accounts"][acc['id']] = {
                 "account_name": acc['name'], "bot_token": acc['bot_token'],
+                "chat_id": acc.get('chat_id') or "", "mute_window": acc.get('mute_window') or "",
                 "notify_curl": "" if clean_curl else acc['notify_curl'], "chat_curl": "" if clean_curl else acc['chat_curl']
             }
         return data
@@ -157,6 +415,67 @@ class BackupManager:
             if len(files) > 10: [os.remove(f) for f in files[:-10]]
         except Exception as e: SYS_LOG.error(f"❌ Auto-backup failed: {e}")
 
+class DataExporter:
+    """Xuất stats / hoạt động shop dạng CSV hoặc NDJSON, đọc cursor theo lô nên bộ nhớ không phụ thuộc số dòng."""
+    BATCH = 500
+    STATS_COLUMNS = ["date", "account_id", "account_name", "category", "count"]
+    ACTIVITY_COLUMNS = ["time", "account_id", "account_name", "granularity", "category", "delta", "events", "status"]
+
+    @staticmethod
+    def _acc_filter(column, account_ids):
+        if not account_ids: return "", []
+        return f" AND {column} IN ({','.join('?' * len(account_ids))})", list(account_ids)
+
+    @classmethod
+    def _rows(cls, sql, params):
+        # Connection riêng cho mỗi lần export, đóng khi client ngắt hoặc đọc xong
+        conn = DB.get_connection()
+        try:
+            cur = conn.execute(sql, params)
+            while True:
+                batch = cur.fetchmany(cls.BATCH)
+                if not batch: break
+                yield from batch
+        finally: conn.close()
+
+    @classmethod
+    def stats_rows(cls, start_date, end_date, account_ids):
+        acc_sql, acc_params = cls._acc_filter("s.account_id", account_ids)
+        sql = f"""SELECT s.date, s.account_id, COALESCE(a.name, '') AS account_name, s.category, s.count FROM stats s
+            LEFT JOIN accounts a ON a.id = s.account_id WHERE s.date >= ? AND s.date <= ?{acc_sql} ORDER BY s.date, s.account_id, s.category"""
+        for r in cls._rows(sql, [start_date, end_date] + acc_params): yield dict(r)
+
+    @classmethod
+    def activity_rows(cls, start_ts, end_ts, account_ids):
+        acc_sql, acc_params = cls._acc_filter("account_id", account_ids)
+        sql = f"""SELECT x.ts, x.account_id, COALESCE(a.name, '') AS account_name, x.granularity, x.category, x.delta, x.events, x.status FROM (
+                SELECT ts, account_id, 'raw' AS granularity, category, delta, 1 AS events, status FROM events WHERE ts >= ? AND ts < ?{acc_sql}
+                UNION ALL
+                SELECT bucket, account_id, CASE span WHEN 3600 THEN 'hour' ELSE 'day' END, category, total, events, NULL FROM event_rollups WHERE bucket >= ? AND bucket < ?{acc_sql}
+            ) x LEFT JOIN accounts a ON a.id = x.account_id ORDER BY x.ts"""
+        params = [start_ts, end_ts] + acc_params + [start_ts, end_ts] + acc_params
+        for r in cls._rows(sql, params):
+            row = dict(r)
+            ts = row.pop("ts")
+            row = {"time": datetime.fromtimestamp(ts, VN_TZ).strftime("%Y-%m-%d %H:%M:%S"), **row}
+            row["status"] = EventStore.STATUS_NAME.get(row["status"], "") if row["status"] is not None else ""
+            yield row
+
+    @staticmethod
+    def encode(rows, columns, fmt):
+        if fmt == "ndjson":
+            for row in rows: yield json.dumps(row, ensure_ascii=False) + "\n"
+            return
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=columns, extrasaction="ignore")
+        yield "\ufeff"  # BOM để Excel đọc đúng tiếng Việt
+        writer.writeheader()
+        for i, row in enumerate(rows, 1):
+            writer.writerow(row)
+            if i % DataExporter.BATCH == 0:
+                yield buf.getvalue(); buf.seek(0); buf.truncate()
+        yield buf.getvalue()
+
 # ==============================================================================
 # 4. CORE LOGIC
 # ==============================================================================
@@ -191,6 +510,50 @@ class Utils:
         if len(parts) > 0 and all(re.fullmatch(r"\d+", p or "") for p in parts): return {"raw": s, "numbers": [int(p) for p in parts]}
         return {"raw": s}
     
+    @staticmethod
+    def iter_json_array(chunks: Iterable[bytes]) -> Iterator[Any]:
+        """Parse mảng JSON top-level theo từng phần tử khi dữ liệu về dần; dừng lặp sớm = không tải phần còn lại.
+        Raise ValueError nếu body không phải mảng hoặc bị cắt trước dấu "]"."""
+        decoder = json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        buf, pos, started = "", 0, False
+        for chunk in chunks:
+            buf += utf8.decode(chunk) if isinstance(chunk, bytes) else chunk
+            while True:
+                while pos < len(buf) and buf[pos] in " \t\r\n,": pos += 1
+                if pos >= len(buf): break
+                if not started:
+                    if buf[pos] != "[": raise ValueError("Response không phải mảng JSON")  # HTML, object...
+                    started = True; pos += 1; continue
+                if buf[pos] == "]": return
+                try: obj, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError: break  # phần tử chưa về đủ
+                if end == len(buf) and not isinstance(obj, (dict, list)): break  # số/chuỗi có thể còn bị cắt
+                yield obj
+                pos = end
+            buf, pos = buf[pos:], 0
+        raise ValueError("Mảng JSON bị cắt" if started else "Response rỗng")
+
+    @staticmethod
+    def chat_date_key(value):
+        # Khoá so sánh cho trường "date": số (timestamp) hoặc chuỗi ISO; None nếu không có
+        if value is None or value == "": return None
+        if isinstance(value, (int, float)): return (0, float(value))
+        text = str(value).strip()
+        return (0, float(text)) if re.fullmatch(r"\d+(\.\d+)?", text) else (1, text)
+
+    @staticmethod
+    def in_mute_window(spec: str, now: datetime) -> bool:
+        # spec: "23:00-07:00" hoặc nhiều khung "12:00-13:30, 23:00-07:00" (giờ VN)
+        minute = now.hour * 60 + now.minute
+        for part in (spec or "").split(","):
+            m = re.fullmatch(r"\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*", part)
+            if not m: continue
+            start = int(m.group(1)) * 60 + int(m.group(2))
+            end = int(m.group(3)) * 60 + int(m.group(4))
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end): return True
+        return False
+
     @staticmethod
     def get_labels(length: int) -> List[str]:
         labels = [f"Mục {i+1}" for i in range(length)]
@@ -217,58 +580,294 @@ class Utils:
         if "dịch vụ" in low: return "🛎️"
         return "🔹"
 
+class DeadlineExceeded(Exception):
+    pass
+
+class Deadline:
+    """Ngân sách thời gian: 1 cái cho cả tick, mỗi shop lấy phần con qua share() (dùng chung cho notify + chat)."""
+    def __init__(self, budget: float):
+        self.expires_at = time.monotonic() + budget
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+    def share(self, cap: float) -> "Deadline":
+        return Deadline(min(cap, self.remaining()))
+    def check(self):
+        if self.remaining() <= 0: raise DeadlineExceeded()
+
+HTTP_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedge")
+
+class TimeoutPolicy:
+    """Connect/read timeout tách riêng, retry có jitter và hedge request khi vượt p95 (theo từng shop)."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=200)
+        self.stats = {"requests": 0, "failures": 0, "retries": 0, "timeouts": 0, "hedged": 0, "hedge_wins": 0, "deadline_skips": 0}
+
+    def _bump(self, key, n=1):
+        with self.lock: self.stats[key] += n
+
+    def record(self, elapsed: float):
+        with self.lock: self.latencies.append(elapsed)
+
+    def p95(self) -> Optional[float]:
+        with self.lock:
+            if len(self.latencies) < SystemConfig.HEDGE_MIN_SAMPLES: return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def timeouts(self, deadline: Deadline):
+        remaining = deadline.remaining()
+        if remaining <= 0: raise DeadlineExceeded()
+        read = min(SystemConfig.READ_TIMEOUT, remaining)
+        return (min(SystemConfig.CONNECT_TIMEOUT, read), read)
+
+    def _timed(self, send, timeout):
+        start = time.monotonic()
+        resp = send(timeout)
+        self.record(time.monotonic() - start)
+        return resp
+
+    def _attempt(self, send, deadline: Deadline):
+        timeout = self.timeouts(deadline)
+        hedge_after = self.p95() if SystemConfig.HEDGE_REQUESTS else None
+        if hedge_after is None or hedge_after >= timeout[1]: return self._timed(send, timeout)
+        first = HTTP_POOL.submit(self._timed, send, timeout)
+        done, _ = wait([first], timeout=hedge_after)
+        if done: return first.result()
+        try: second = HTTP_POOL.submit(self._timed, send, self.timeouts(deadline))
+        except DeadlineExceeded: return first.result()
+        self._bump("hedged")
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                try: resp = fut.result()
+                except Exception as e: error = e; continue
+                if fut is second: self._bump("hedge_wins")
+                # Request thua vẫn chạy nốt: đóng response của nó để trả connection về pool (stream=True)
+                for loser in pending: loser.add_done_callback(self._close_result)
+                return resp
+        raise error
+
+    @staticmethod
+    def _close_result(fut):
+        if not fut.cancelled() and fut.exception() is None: fut.result().close()
+
+    def execute(self, send, deadline: Deadline):
+        """send(timeout) -> Response. Retry lỗi mạng / 5xx trong giới hạn deadline."""
+        self._bump("requests")
+        attempt = 0
+        while True:
+            try:
+                resp = self._attempt(send, deadline)
+                if resp.status_code < 500 or attempt >= SystemConfig.MAX_RETRIES: return resp
+                resp.close()  # 5xx sẽ retry: bỏ response này
+            except DeadlineExceeded:
+                self._bump("deadline_skips"); raise
+            except requests.RequestException as e:
+                if isinstance(e, requests.Timeout): self._bump("timeouts")
+                if attempt >= SystemConfig.MAX_RETRIES: self._bump("failures"); raise
+            delay = random.uniform(0, SystemConfig.RETRY_BACKOFF * (2 ** attempt))
+            if delay >= deadline.remaining():
+                self._bump("deadline_skips"); raise DeadlineExceeded()
+            time.sleep(delay)
+            attempt += 1
+            self._bump("retries")
+
+    def snapshot(self) -> Dict[str, Any]:
+        p95 = self.p95()
+        with self.lock: data = dict(self.stats)
+        data["p95_ms"] = round(p95 * 1000) if p95 is not None else None
+        return data
+
+class CookieJar:
+    """Cookie của 1 shop: seed từ cURL, gộp Set-Cookie trả về từ TapHoa và lưu SQLite để sống qua restart."""
+    def __init__(self, acc_id, *configs):
+        self.acc_id = acc_id
+        self.lock = threading.Lock()
+        seed = {}
+        for config in configs:
+            for k, v in config.get("headers", {}).items():
+                if k.lower() == "cookie": seed.update(self.parse(v))
+        self.seed_hash = hashlib.sha256(json.dumps(seed, sort_keys=True).encode()).hexdigest()
+        self.cookies = {name: {"value": value, "expires": None} for name, value in seed.items()}
+        stored, self.seeded_at, self.refreshed_at = DB.load_cookie_jar(acc_id, self.seed_hash)
+        now = time.time()
+        for row in stored:
+            # value rỗng = server đã xoá cookie này; đã quá hạn cũng coi như đã xoá
+            if row['value'] and not (row['expires'] and row['expires'] <= now): self.cookies[row['name']] = {"value": row['value'], "expires": row['expires']}
+            else: self.cookies.pop(row['name'], None)
+
+    @staticmethod
+    def parse(header: str) -> Dict[str, str]:
+        out = {}
+        for part in (header or "").split(";"):
+            if "=" in part:
+                k, v = part.split("=", 1)
+                if k.strip(): out[k.strip()] = v.strip()
+        return out
+
+    def _purge_expired(self, now):
+        # Gọi khi đang giữ self.lock; cookie hết hạn không gửi đi nữa nên bỏ khỏi jar luôn
+        for name in [k for k, c in self.cookies.items() if c['expires'] and c['expires'] <= now]: del self.cookies[name]
+
+    def header(self) -> str:
+        with self.lock:
+            self._purge_expired(time.time())
+            return "; ".join(f"{k}={c['value']}" for k, c in self.cookies.items())
+
+    def absorb(self, resp):
+        """Gộp Set-Cookie của response (kể cả redirect) vào jar, chỉ ghi DB khi có thay đổi."""
+        jars = [r.cookies for r in getattr(resp, "history", [])] + [resp.cookies]
+        now = time.time()
+        upserts, deletes = {}, set()
+        with self.lock:
+            for jar in jars:
+                for c in jar:
+                    if not c.value or c.value == "deleted" or (c.expires is not None and c.expires <= now):
+                        if c.name in self.cookies:
+                            del self.cookies[c.name]; deletes.add(c.name); upserts.pop(c.name, None)
+                        continue
+                    cur = self.cookies.get(c.name)
+                    if cur and cur['value'] == c.value and cur['expires'] == c.expires: continue
+                    self.cookies[c.name] = upserts[c.name] = {"value": c.value, "expires": c.expires}
+                    deletes.discard(c.name)
+            if not upserts and not deletes: return
+            self.refreshed_at = int(now)
+        try: DB.save_cookies(self.acc_id, upserts, deletes)
+        except Exception as e: SYS_LOG.error(f"❌ Lưu cookie thất bại: {e}", key=f"cookie:{self.acc_id}")
+
+    def summary(self) -> Dict[str, Any]:
+        now = time.time()
+        with self.lock:
+            self._purge_expired(now)
+            expiries = [c['expires'] for c in self.cookies.values() if c['expires']]
+            count = len(self.cookies)
+        since = self.refreshed_at or self.seeded_at
+        return {"count": count, "age_s": int(now - since) if since else None, "refreshed": bool(self.refreshed_at),
+                "next_expiry_s": int(min(expiries) - now) if expiries else None}
+
 class AccountProcessor:
     def __init__(self, account_data: dict):
         self.id = account_data['id']
         self.name = account_data.get('name') or account_data.get('account_name') or 'Unknown'
         self.bot_token = account_data['bot_token']
+        self.chat_id = (account_data.get('chat_id') or "").strip()
+        self.mute_window = account_data.get('mute_window') or ""
         self.notify_config = Utils.parse_curl(account_data['notify_curl'])
         self.chat_config = Utils.parse_curl(account_data['chat_curl'])
         self.last_notify_nums = []
-        self.seen_chat_dates = set()
+        self.seen_chat_dates = {}  # dict dùng như ordered set, mới nhất ở cuối
+        self.chat_sorted = False
+        self.chat_cursor = None
         self.daily_date = ""
         self.cookie_alert_sent = False 
-
-    def make_request(self, config):
-        kwargs = {"headers": config.get("headers", {}), "verify": SystemConfig.VERIFY_TLS, "timeout": 25}
+        self.http = TimeoutPolicy()
+        self.last_push_at = 0.0
+        self.cookies = CookieJar(self.id, self.chat_config, self.notify_config)
+        cursor = DB.get_setting(f"chat_cursor:{self.id}")
+        if cursor: self.chat_cursor = json.loads(cursor)
+
+    def make_request(self, config, deadline: Optional[Deadline] = None, stream=False):
+        headers = {k: v for k, v in config.get("headers", {}).items() if k.lower() != "cookie"}
+        cookie = self.cookies.header()
+        if cookie: headers["cookie"] = cookie
+        kwargs = {"headers": headers, "verify": SystemConfig.VERIFY_TLS, "stream": stream}
         if config.get("method") == "POST":
             if config.get("body_json"): kwargs["json"] = config["body_json"]
             elif config.get("body_data"): kwargs["data"] = config["body_data"].encode('utf-8')
-        return requests.request(config.get("method", "GET"), config.get("url", ""), **kwargs)
+        send = lambda timeout: requests.request(config.get("method", "GET"), config.get("url", ""), timeout=timeout, **kwargs)
+        resp = self.http.execute(send, deadline or Deadline(SystemConfig.SHOP_BUDGET))
+        self.cookies.absorb(resp)
+        return resp
 
-    def fetch_chats(self, is_baseline=False) -> List[str]:
+    def status(self) -> Dict[str, Any]:
+        stats = self.http.snapshot()
+        return {"counters": self.last_notify_nums, "cookie_expired": self.cookie_alert_sent,
+                "push_mode": time.time() - self.last_push_at < SystemConfig.PUSH_WINDOW,
+                "requests": stats["requests"], "failures": stats["failures"], "p95_ms": stats["p95_ms"], "cookie": self.cookies.summary()}
+
+    def chat_request_config(self):
+        # Nếu URL / body cURL chứa {cursor} thì thay bằng "date" mới nhất đã thấy -> upstream chỉ trả hội thoại mới hơn
+        cfg = self.chat_config
+        marker = "{cursor}"
+        body_json_text = json.dumps(cfg["body_json"]) if cfg.get("body_json") else ""
+        if marker not in cfg.get("url", "") and marker not in (cfg.get("body_data") or "") and marker not in body_json_text: return cfg
+        cursor = "" if self.chat_cursor is None else str(self.chat_cursor)
+        cfg = dict(cfg, url=cfg.get("url", "").replace(marker, quote(cursor, safe="")))
+        if cfg.get("body_data"): cfg["body_data"] = cfg["body_data"].replace(marker, cursor)
+        if body_json_text: cfg["body_json"] = json.loads(body_json_text.replace(marker, json.dumps(cursor)[1:-1]))
+        return cfg
+
+    @staticmethod
+    def chunks_within(resp, deadline: Deadline):
+        # Read timeout chỉ tính cho từng lần đọc socket; kiểm tra deadline giữa các chunk để body dài / nhỏ giọt không vượt ngân sách
+        for chunk in resp.iter_content(chunk_size=8192):
+            deadline.check()
+            yield chunk
+
+    def fetch_chats(self, is_baseline=False, deadline: Optional[Deadline] = None, limit: Optional[int] = None) -> List[str]:
+        """Đọc danh sách chat dạng stream; dừng khi gặp hội thoại đã thấy (nếu upstream sắp xếp mới nhất trước) hoặc đủ `limit` chat mới."""
         if not self.chat_config.get("url"): return []
+        deadline = deadline or Deadline(SystemConfig.SHOP_BUDGET)
         try:
-            r = self.make_request(self.chat_config)
-            try: data = r.json()
-            except: return []
-            if not isinstance(data, list): return []
-            new_msgs = []
-            curr_ids = set()
-            for chat in data:
-                if not isinstance(chat, dict): continue
-                uid = chat.get("guest_user", "Khách")
-                msg = chat.get("last_chat", "")
-                mid = chat.get("date") or hashlib.sha256(f"{uid}:{msg}".encode()).hexdigest()
-                curr_ids.add(mid)
-                if mid not in self.seen_chat_dates:
-                    self.seen_chat_dates.add(mid)
-                    if not is_baseline: 
-                        new_msgs.append(f"<b>✉️ {html.escape(uid)}:</b> <i>{html.escape(msg)}</i>")
-            self.seen_chat_dates.intersection_update(curr_ids)
+            r = self.make_request(self.chat_request_config(), deadline, stream=True)
+            cursor_key = Utils.chat_date_key(self.chat_cursor)
+            new_msgs, scanned = [], []
+            newest, prev_key, keyed = None, None, 0
+            ordered, complete, limit_hit, cut_by_limit = True, True, False, False
+            try:
+                for chat in Utils.iter_json_array(self.chunks_within(r, deadline)):
+                    if not isinstance(chat, dict): continue
+                    uid = chat.get("guest_user", "Khách")
+                    msg = chat.get("last_chat", "")
+                    mid = chat.get("date") or hashlib.sha256(f"{uid}:{msg}".encode()).hexdigest()
+                    key = Utils.chat_date_key(chat.get("date"))
+                    if key is not None:
+                        keyed += 1
+                        if prev_key is not None and key > prev_key: ordered = False
+                        prev_key = key
+                        if newest is None or key > newest[0]: newest = (key, chat.get("date"))
+                    below_cursor = cursor_key is not None and key is not None and key <= cursor_key
+                    if limit_hit:
+                        # Đủ `limit` rồi: xem thêm 1 phần tử (không đánh dấu đã thấy); nó cũ (dưới cursor / đã thấy) = không còn chat mới bên dưới
+                        cut_by_limit = not (below_cursor or mid in self.seen_chat_dates)
+                        break
+                    scanned.append(mid)
+                    # Chỉ dừng ở mốc cursor (đã quét đủ trước đó); chat đã báo nhưng còn trên cursor thì bỏ qua và quét tiếp
+                    if below_cursor and not is_baseline and self.chat_sorted: complete = False; break
+                    if below_cursor or mid in self.seen_chat_dates: continue
+                    if not is_baseline:
+                        new_msgs.append(f"<b>✉️ {html.escape(str(uid))}:</b> <i>{html.escape(str(msg))}</i>")
+                        if limit and len(new_msgs) >= limit: complete = False; limit_hit = True
+            finally: r.close()
+
+            if is_baseline: self.chat_sorted = ordered and keyed > 1
+            if complete: self.seen_chat_dates = dict.fromkeys(reversed(scanned))
+            else:
+                for mid in reversed(scanned):
+                    self.seen_chat_dates.pop(mid, None); self.seen_chat_dates[mid] = True
+                while len(self.seen_chat_dates) > 1000: del self.seen_chat_dates[next(iter(self.seen_chat_dates))]
+            # Dừng vì đủ `limit` mà phần tử kế tiếp vẫn là chat mới -> còn chat chưa quét bên dưới, giữ nguyên cursor
+            if newest and not cut_by_limit and (cursor_key is None or newest[0] > cursor_key):
+                self.chat_cursor = newest[1]
+                DB.set_setting(f"chat_cursor:{self.id}", json.dumps(self.chat_cursor))
             return new_msgs
+        except DeadlineExceeded: self.http._bump("deadline_skips"); return []
         except: return []
 
-    def check_notify(self, global_chat_id, is_baseline=False):
+    def check_notify(self, global_chat_id, is_baseline=False, deadline: Optional[Deadline] = None):
         if not self.notify_config.get("url"): return
+        deadline = deadline or Deadline(SystemConfig.SHOP_BUDGET)
         try:
-            r = self.make_request(self.notify_config)
+            r = self.make_request(self.notify_config, deadline)
             text = (r.text or "").strip()
             
             if "<html" in text.lower():
                 if not self.cookie_alert_sent and not is_baseline:
-                    self.send_tele(global_chat_id, f"⚠️ <b>[{html.escape(self.name)}] Cookie đã hết hạn!</b>\nVui lòng cập nhật ngay.")
-                    self.cookie_alert_sent = True
+                    # Đang trong giờ tắt thông báo thì chưa đánh dấu, tick sau ngoài khung giờ sẽ báo lại
+                    self.cookie_alert_sent = ROUTER.submit(self, global_chat_id, f"⚠️ <b>[{html.escape(self.name)}] Cookie đã hết hạn!</b>\nVui lòng cập nhật ngay.")
                 return
             
             self.cookie_alert_sent = False
@@ -282,13 +881,18 @@ class AccountProcessor:
                 if len(nums) != len(self.last_notify_nums): self.last_notify_nums = [0] * len(nums)
                 labels = Utils.get_labels(len(nums))
                 alerts = []
+                events = []
                 has_change = False
                 check_chat = False
+                msg_delta = 0
+                # Shop đang push đơn qua webhook thì bỏ qua counter đơn hàng để không báo trùng
+                push_mode = time.time() - self.last_push_at < SystemConfig.PUSH_WINDOW
                 
                 for i, val in enumerate(nums):
                     old = self.last_notify_nums[i]
                     lbl = labels[i]
                     if "khiếu nại" in lbl.lower(): continue 
+                    if push_mode and "đơn hàng" in lbl.lower(): continue
 
                     if val > old:
                         has_change = True
@@ -296,13 +900,15 @@ class AccountProcessor:
                         # Update Stats DB
                         cat_code = 'msg' if "tin nhắn" in lbl.lower() else ('order' if "đơn hàng" in lbl.lower() else 'other')
                         DB.update_stat(self.id, today, cat_code, diff)
+                        events.append((cat_code, diff))
                         
-                        if "tin nhắn" in lbl.lower(): check_chat = True
+                        if "tin nhắn" in lbl.lower(): check_chat = True; msg_delta += diff
                     
                     if val > 0 and val > old:
                          alerts.append(f"{Utils.get_icon(lbl)} {lbl}: <b>{val}</b>")
                 
-                chat_msgs = self.fetch_chats(is_baseline) if check_chat else []
+                chat_msgs = self.fetch_chats(is_baseline, deadline, limit=msg_delta) if check_chat else []
+                if chat_msgs: events.append(('chat', len(chat_msgs)))
                 
                 if has_change and not is_baseline:
                     # ==========================================================
@@ -319,43 +925,127 @@ class AccountProcessor:
                         msg_lines.append("\n💬 <b>CÓ TIN NHẮN KHÁCH:</b>")
                         msg_lines.extend(chat_msgs)
 
-                    self.send_tele(global_chat_id, "\n".join(msg_lines))
+                    ROUTER.submit(self, global_chat_id, "\n".join(msg_lines), lambda st, ev=events: EVENTS.record(self.id, ev, st))
+                else: EVENTS.record(self.id, events, "baseline" if is_baseline else "skipped")
                 
                 self.last_notify_nums = nums
-        except Exception as e: SYS_LOG.error(f"Err {self.name}: {e}")
-
-    def send_tele(self, chat_id, text):
-        if not self.bot_token or not chat_id: return
-        api = f"https://api.telegram.org/bot{self.bot_token}/sendMessage"
-        chunks = [text[i:i+3900] for i in range(0, len(text), 3900)] or [""]
-        for part in chunks[:3]:
-            try: requests.post(api, json={"chat_id": chat_id, "text": part, "parse_mode": "HTML"}, timeout=15)
-            except: pass
+        except DeadlineExceeded: SYS_LOG.error(f"Err {self.name}: hết ngân sách thời gian cho tick này", key=f"notify:{self.id}")
+        except Exception as e: SYS_LOG.error(f"Err {self.name}: {e}", key=f"notify:{self.id}", error=type(e).__name__)
+
+    def ingest_orders(self, global_chat_id, orders: List[dict]):
+        """Đơn push từ webhook (đã lọc trùng) -> stats + event log + Telegram, giống check_notify."""
+        self.last_push_at = time.time()
+        if not orders: return
+        today = get_vn_time().strftime("%Y-%m-%d")
+        DB.update_stat(self.id, today, 'order', len(orders))
+        msg_lines = [f"⭐ <b>BÁO CÁO NHANH - [{html.escape(self.name)}]</b>"]
+        msg_lines.append("<code>_ _ _ _ _ _ _ _ _ _ _ _ _</code>")
+        msg_lines.append(f"🛒 <b>CÓ {len(orders)} ĐƠN HÀNG MỚI:</b>")
+        for o in orders:
+            line = f"📦 <b>{html.escape(str(o.get('product_name') or 'Sản phẩm'))}</b> x{html.escape(str(o.get('quantity', 1)))}"
+            if o.get("total") is not None: line += f" — <b>{html.escape(str(o['total']))}đ</b>"
+            if o.get("buyer_name"): line += f"\n   👤 {html.escape(str(o['buyer_name']))}"
+            if o.get("status"): line += f" · <i>{html.escape(str(o['status']))}</i>"
+            msg_lines.append(line)
+        ROUTER.submit(self, global_chat_id, "\n".join(msg_lines), lambda st, n=len(orders): EVENTS.record(self.id, [('order', n)], st))
+
+class NotificationRouter:
+    """Gom tin theo (bot_token, chat_id): bỏ tin trùng, đóng gói nhiều báo cáo vào 1 tin Telegram."""
+    MAX_LEN = 3900
+    FLUSH_AFTER = 2.0  # giây: tin chờ gom tối đa bấy nhiêu rồi gửi, không đợi hết lượt poll
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = []  # [(bot_token, chat_id, text, on_done)]
+        self.oldest_at = 0.0
+        self.stats = {"submitted": 0, "deduped": 0, "muted": 0, "api_calls": 0, "failed_calls": 0}
+
+    def destination(self, proc, global_chat_id):
+        chat_id = proc.chat_id or global_chat_id
+        if not proc.bot_token or not chat_id: return None
+        return (proc.bot_token, str(chat_id))
+
+    def submit(self, proc, global_chat_id, text, on_done=None) -> bool:
+        """True nếu tin đã vào hàng đợi; False nếu shop đang tắt thông báo hoặc không có nơi nhận."""
+        dest = self.destination(proc, global_chat_id)
+        if dest and Utils.in_mute_window(proc.mute_window, get_vn_time()):
+            with self.lock: self.stats["muted"] += 1
+            if on_done: on_done("muted")
+            return False
+        if not dest:
+            if on_done: on_done("failed")
+            return False
+        with self.lock:
+            self.stats["submitted"] += 1
+            if not self.pending: self.oldest_at = time.monotonic()
+            self.pending.append((dest[0], dest[1], text, on_done))
+        return True
+
+    @classmethod
+    def pack(cls, texts: List[str]) -> List[str]:
+        packed, cur = [], ""
+        for t in texts:
+            if len(t) > cls.MAX_LEN:
+                if cur: packed.append(cur); cur = ""
+                packed.extend([t[i:i+cls.MAX_LEN] for i in range(0, len(t), cls.MAX_LEN)][:3])
+            elif cur and len(cur) + 2 + len(t) <= cls.MAX_LEN: cur += "\n\n" + t
+            else:
+                if cur: packed.append(cur)
+                cur = t
+        if cur: packed.append(cur)
+        return packed
+
+    def post(self, bot_token, chat_id, text) -> bool:
+        api = f"https://api.telegram.org/bot{bot_token}/sendMessage"
+        try: ok = requests.post(api, json={"chat_id": chat_id, "text": text, "parse_mode": "HTML"}, timeout=(SystemConfig.CONNECT_TIMEOUT, 15)).ok
+        except: ok = False
+        with self.lock:
+            self.stats["api_calls"] += 1
+            if not ok: self.stats["failed_calls"] += 1
+        return ok
+
+    def flush_due(self):
+        with self.lock: due = bool(self.pending) and time.monotonic() - self.oldest_at >= self.FLUSH_AFTER
+        if due: self.flush()
+
+    def flush(self):
+        with self.lock: batch, self.pending = self.pending, []
+        if not batch: return
+        groups = defaultdict(list)
+        for bot_token, chat_id, text, on_done in batch: groups[(bot_token, chat_id)].append((text, on_done))
+        for (bot_token, chat_id), items in groups.items():
+            texts = list(dict.fromkeys(text for text, _ in items))
+            with self.lock: self.stats["deduped"] += len(items) - len(texts)
+            ok = True
+            for msg in self.pack(texts): ok = self.post(bot_token, chat_id, msg) and ok
+            for _, on_done in items:
+                if on_done: on_done("sent" if ok else "failed")
 
 class BackgroundService:
     def __init__(self):
         self.processors = {}
         self.lock = threading.Lock()
+        self.reload_lock = threading.Lock()
+        self.tick = 0
     def reload_processors(self):
-        with self.lock:
-            db_accounts = DB.get_all_accounts()
-            current_ids = set()
-            for acc in db_accounts:
-                aid = acc['id']
-                current_ids.add(aid)
-                if aid not in self.processors: self.processors[aid] = AccountProcessor(acc)
-                else: 
-                    old = self.processors[aid]
-                    new = AccountProcessor(acc)
+        # Dựng processor mới (đọc DB, cookie jar) ngoài self.lock; chỉ giữ lock lúc tráo dict
+        with self.reload_lock:
+            fresh = {acc['id']: AccountProcessor(acc) for acc in DB.get_all_accounts()}
+            with self.lock:
+                for aid, new in fresh.items():
+                    old = self.processors.get(aid)
+                    if old is None: continue
                     new.last_notify_nums = old.last_notify_nums
                     new.seen_chat_dates = old.seen_chat_dates
+                    new.chat_sorted = old.chat_sorted
                     new.cookie_alert_sent = old.cookie_alert_sent 
-                    self.processors[aid] = new
-            for aid in list(self.processors.keys()):
-                if aid not in current_ids: del self.processors[aid]
+                    new.http = old.http
+                    new.last_push_at = old.last_push_at
+                    # Cùng seed cURL: giữ jar đang chạy, kể cả Set-Cookie vừa nhận trong lúc dựng processor mới
+                    if new.cookies.seed_hash == old.cookies.seed_hash: new.cookies = old.cookies
+                self.processors = fresh
     
     def broadcast_config_success(self, global_chat_id):
-        if not global_chat_id: return
+        # Không chặn khi thiếu Master ID: ROUTER.destination tự chọn chat_id riêng của shop
         vn_time = get_vn_time().strftime('%H:%M:%S')
         msg = (
             f"🚀 <b>HỆ THỐNG ĐÃ KHỞI ĐỘNG!</b> 🚀\n\n"
@@ -366,35 +1056,215 @@ class BackgroundService:
         )
         with self.lock:
             for proc in self.processors.values():
-                proc.send_tele(global_chat_id, msg)
+                ROUTER.submit(proc, global_chat_id, msg)
+        ROUTER.flush()
 
-    def pinger_loop(self):
-        while True:
-            try:
-                enabled = DB.get_setting("pinger_enabled") == "1"
-                url = DB.get_setting("pinger_url")
-                interval = int(DB.get_setting("pinger_interval", "300"))
-                if enabled and url: requests.get(url, timeout=10)
-                time.sleep(max(10, interval))
-            except: time.sleep(60)
-    def poller_loop(self):
-        self.reload_processors()
-        global_chat_id = DB.get_setting("global_chat_id")
+    def resolve_processor(self, account_id=None, shop_name=None):
         with self.lock:
-            for proc in self.processors.values():
-                proc.fetch_chats(is_baseline=True)
-                proc.check_notify(global_chat_id, is_baseline=True)
+            if account_id: return self.processors.get(account_id)
+            if shop_name:
+                key = shop_name.strip().lower()
+                for proc in self.processors.values():
+                    if proc.name.strip().lower() == key: return proc
+            if len(self.processors) == 1: return next(iter(self.processors.values()))
+        return None
+
+    def ping(self):
+        conf = DB.get_settings("pinger_enabled", "pinger_url", "pinger_interval")
+        if conf.get("pinger_enabled") == "1" and conf.get("pinger_url"): requests.get(conf["pinger_url"], timeout=10)
+        return max(10, int(conf.get("pinger_interval") or 300))
+
+    def poll_tick(self):
+        """1 tick poller (chạy qua SCHEDULER). Lần đầu chỉ chạy baseline. Trả về interval tới tick sau."""
+        conf = DB.get_settings("global_chat_id", "poll_interval")
+        global_chat_id = conf.get("global_chat_id")
+        interval = max(3, int(conf.get("poll_interval") or SystemConfig.DEFAULT_POLL_INTERVAL))
+        if self.tick == 0:
+            self.reload_processors()
+            with self.lock: procs = list(self.processors.values())
+            for proc, deadline in self.shop_deadlines(procs):
+                proc.fetch_chats(is_baseline=True, deadline=deadline)
+                proc.check_notify(global_chat_id, is_baseline=True, deadline=deadline)
+            self.tick = 1
+            return interval
+        self.tick += 1
+        with self.lock: procs = list(self.processors.values())
+        if procs:
+            # Xoay vòng thứ tự để shop cuối danh sách không luôn là shop bị cắt khi hết ngân sách tick
+            start = self.tick % len(procs); procs = procs[start:] + procs[:start]
+        for proc, deadline in self.shop_deadlines(procs):
+            with SYS_LOG.context(tick=self.tick, account=proc.id, shop=proc.name): proc.check_notify(global_chat_id, deadline=deadline)
+            ROUTER.flush_due()  # tin chờ quá FLUSH_AFTER thì gửi ngay, không đợi cả lượt
+        ROUTER.flush()
+        return interval
+
+    def shop_deadlines(self, procs):
+        # 1 ngân sách TICK_BUDGET cho cả lượt, mỗi shop tối đa SHOP_BUDGET: k shop treo không cộng dồn k x timeout
+        tick = Deadline(SystemConfig.TICK_BUDGET)
+        for i, proc in enumerate(procs):
+            if tick.remaining() <= 0:
+                SYS_LOG.error(f"⏱️ Hết ngân sách tick {SystemConfig.TICK_BUDGET}s, bỏ qua {len(procs) - i} shop tới lượt sau", key="tick-budget")
+                return
+            yield proc, tick.share(SystemConfig.SHOP_BUDGET)
+
+class JobScheduler:
+    """1 thread hẹn giờ (min-heap) cho mọi job nền: interval + jitter, không chạy chồng, lưu lịch sử chạy."""
+    def __init__(self, workers=4):
+        self.cond = threading.Condition()
+        self.heap = []  # [(due_monotonic, seq, name)]
+        self.jobs = {}
+        self.seq = 0
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self.thread = None
+
+    def add(self, name, func, interval, jitter=0.1, first_delay=None):
+        """interval: giây. func có thể trả về số giây để đổi interval cho lần chạy kế tiếp."""
+        with self.cond:
+            self.jobs[name] = {"name": name, "func": func, "interval": interval, "jitter": jitter, "running": False, "rerun": False,
+                               "runs": 0, "failures": 0, "skipped_overlap": 0, "next_run": None, "history": deque(maxlen=20)}
+            self._schedule(name, interval if first_delay is None else first_delay)
+
+    def _schedule(self, name, delay, jitter=True):
+        # Mỗi job chỉ có 1 entry hợp lệ trong heap (job["seq"]); entry cũ bị bỏ qua khi pop
+        job = self.jobs[name]
+        if jitter: delay = max(0.0, delay * (1 + random.uniform(-job["jitter"], job["jitter"])))
+        self.seq += 1
+        job["seq"] = self.seq
+        job["next_run"] = time.time() + delay
+        heapq.heappush(self.heap, (time.monotonic() + delay, self.seq, name))
+        self.cond.notify()
+
+    def run_now(self, name) -> Optional[str]:
+        """None nếu không có job; "queued" nếu job đang chạy (chạy lại ngay khi xong), ngược lại "scheduled"."""
+        with self.cond:
+            job = self.jobs.get(name)
+            if job is None: return None
+            if job["running"]: job["rerun"] = True; return "queued"
+            self._schedule(name, 0, jitter=False)
+        return "scheduled"
+
+    def _loop(self):
         while True:
-            try:
-                interval = max(3, int(DB.get_setting("poll_interval", str(SystemConfig.DEFAULT_POLL_INTERVAL))))
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.cond.wait(timeout=self.heap[0][0] - time.monotonic() if self.heap else None)
+                _, seq, name = heapq.heappop(self.heap)
+                job = self.jobs.get(name)
+                if job is None or seq != job["seq"]: continue
+                if job["running"]:
+                    # Lần trước chưa xong: bỏ lượt này, lần chạy kế được hẹn khi job kết thúc
+                    job["skipped_overlap"] += 1
+                    continue
+                job["running"] = True
+            self.pool.submit(self._run, job)
+
+    def _run(self, job):
+        started = time.time()
+        entry = {"started": datetime.fromtimestamp(started, VN_TZ).strftime("%Y-%m-%d %H:%M:%S"), "ok": True}
+        next_delay = job["interval"]
+        try:
+            result = job["func"]()
+            if isinstance(result, (int, float)) and result > 0: next_delay = result
+        except Exception as e:
+            entry["ok"] = False; entry["error"] = str(e)[:300]
+            SYS_LOG.error(f"Job {job['name']} lỗi: {e}", key=f"job:{job['name']}")
+        entry["duration_ms"] = round((time.time() - started) * 1000)
+        with self.cond:
+            job["runs"] += 1
+            if not entry["ok"]: job["failures"] += 1
+            job["history"].append(entry)
+            job["running"] = False
+            job["interval"] = next_delay
+            if job["rerun"]: job["rerun"] = False; self._schedule(job["name"], 0, jitter=False)
+            else: self._schedule(job["name"], next_delay)
+
+    def start(self):
+        if self.thread: return
+        self.thread = threading.Thread(target=self._loop, daemon=True, name="scheduler"); self.thread.start()
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self.cond:
+            return [{"name": j["name"], "interval": j["interval"], "jitter": j["jitter"], "running": j["running"], "rerun": j["rerun"], "runs": j["runs"],
+                     "failures": j["failures"], "skipped_overlap": j["skipped_overlap"],
+                     "next_run": datetime.fromtimestamp(j["next_run"], VN_TZ).strftime("%Y-%m-%d %H:%M:%S") if j["next_run"] else None,
+                     "history": list(j["history"])} for j in self.jobs.values()]
+
+class Diagnostics:
+    """Profiler lấy mẫu (mọi thread) + snapshot tracemalloc, giới hạn thời gian / tần số để chạy được trên production."""
+    MAX_SECONDS = 60
+    MAX_HZ = 200
+    MAX_SNAPSHOTS = 5
+
+    def __init__(self):
+        self.profile_lock = threading.Lock()
+        self.snap_lock = threading.Lock()
+        self.snapshots = {}  # id -> (time, Snapshot)
+        self.snap_seq = 0
+
+    @staticmethod
+    def _collapse(frame, max_depth=64):
+        parts = []
+        while frame is not None and len(parts) < max_depth:
+            code = frame.f_code
+            parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ";".join(reversed(parts))
+
+    def profile(self, seconds: float, hz: int) -> str:
+        """Trả về collapsed stacks (định dạng flamegraph.pl / speedscope): 'thread;frame;frame count'."""
+        if not self.profile_lock.acquire(blocking=False): raise RuntimeError("Đang có 1 phiên profile khác chạy")
+        try:
+            seconds = max(1.0, min(float(seconds), self.MAX_SECONDS))
+            interval = 1.0 / max(1, min(int(hz), self.MAX_HZ))
+            me = threading.get_ident()
+            counts = defaultdict(int)
+            end = time.monotonic() + seconds
+            while time.monotonic() < end:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me: continue
+                    counts[f"{names.get(ident, ident)};{self._collapse(frame)}"] += 1
                 time.sleep(interval)
-                global_chat_id = DB.get_setting("global_chat_id")
-                if not global_chat_id: continue
-                with self.lock: procs = list(self.processors.values())
-                for proc in procs: proc.check_notify(global_chat_id)
-            except Exception: time.sleep(60)
+            return "\n".join(f"{stack} {n}" for stack, n in sorted(counts.items(), key=lambda kv: -kv[1]))
+        finally: self.profile_lock.release()
 
+    @staticmethod
+    def app_memory() -> Dict[str, Any]:
+        with SERVICE.lock: procs = list(SERVICE.processors.values())
+        return {"processors": len(procs), "seen_chat_dates": sum(len(p.seen_chat_dates) for p in procs),
+                "router_pending": len(ROUTER.pending), "log": SYS_LOG.status()}
+
+    def take_snapshot(self, frames=10, limit=20) -> Dict[str, Any]:
+        if not tracemalloc.is_tracing(): tracemalloc.start(max(1, min(int(frames), 25)))
+        snap = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")])
+        with self.snap_lock:
+            self.snap_seq += 1
+            sid = self.snap_seq
+            self.snapshots[sid] = (get_vn_time().strftime("%Y-%m-%d %H:%M:%S"), snap)
+            while len(self.snapshots) > self.MAX_SNAPSHOTS: self.snapshots.pop(min(self.snapshots))
+        current, peak = tracemalloc.get_traced_memory()
+        return {"id": sid, "traced_kb": current // 1024, "peak_kb": peak // 1024, "app": self.app_memory(),
+                "top": [{"where": str(st.traceback[0]), "size_kb": st.size // 1024, "count": st.count} for st in snap.statistics("lineno")[:limit]]}
+
+    def diff(self, base_id, target_id, limit=30) -> Dict[str, Any]:
+        with self.snap_lock:
+            base, target = self.snapshots.get(base_id), self.snapshots.get(target_id)
+        if not base or not target: raise KeyError("Snapshot không tồn tại (chỉ giữ %d snapshot gần nhất)" % self.MAX_SNAPSHOTS)
+        stats = target[1].compare_to(base[1], "lineno")
+        return {"base": {"id": base_id, "time": base[0]}, "target": {"id": target_id, "time": target[0]},
+                "top": [{"where": str(st.traceback[0]), "size_diff_kb": round(st.size_diff / 1024, 1), "count_diff": st.count_diff, "size_kb": st.size // 1024} for st in stats[:limit]]}
+
+    def list_snapshots(self):
+        with self.snap_lock: return [{"id": sid, "time": t} for sid, (t, _) in sorted(self.snapshots.items())]
+
+    def stop_tracing(self):
+        with self.snap_lock: self.snapshots.clear()
+        if tracemalloc.is_tracing(): tracemalloc.stop()
+
+ROUTER = NotificationRouter()
 SERVICE = BackgroundService()
+SCHEDULER = JobScheduler()
+DIAG = Diagnostics()
 
 # ==============================================================================
 # 5. API ROUTES
@@ -425,20 +1295,46 @@ def logout():
     return resp
 
 @app.get("/healthz")
-def health(): return {"status": "ok"}
+async def health(): return {"status": "ok"}  # chạy thẳng trên event loop, không phụ thuộc threadpool
+
+@app.post("/taphoammo")
+def taphoammo_webhook(payload: Any = Body(...), account_id: Optional[str] = None, x_auth_secret: Optional[str] = Header(None)):
+    secret = SystemConfig.WEBHOOK_SECRET
+    if not secret: raise HTTPException(status_code=503, detail="WEBHOOK_SECRET chưa được cấu hình")
+    if not hmac.compare_digest((x_auth_secret or "").encode(), secret.encode()):
+        raise HTTPException(status_code=403, detail="Invalid secret")
+
+    if isinstance(payload, dict): orders = payload.get("orders") if isinstance(payload.get("orders"), list) else [payload]
+    elif isinstance(payload, list): orders = payload
+    else: raise HTTPException(status_code=400, detail="Payload phải là object hoặc mảng đơn hàng")
+    if len(orders) > SystemConfig.WEBHOOK_MAX_BATCH: raise HTTPException(status_code=413, detail=f"Tối đa {SystemConfig.WEBHOOK_MAX_BATCH} đơn / request")
+
+    global_chat_id = DB.get_setting("global_chat_id")
+    grouped = defaultdict(list)
+    result = {"accepted": 0, "duplicate": 0, "rejected": 0}
+    for order in orders:
+        # Kiểm tra kiểu từng đơn trước khi claim: 1 đơn lỗi không được làm hỏng cả batch (đơn đã claim mà chưa ingest = mất khi retry)
+        if not isinstance(order, dict): result["rejected"] += 1; continue
+        oid, acc, shop = order.get("order_id"), account_id or order.get("account_id"), order.get("shop")
+        if not isinstance(oid, (str, int)) or isinstance(oid, bool) or not isinstance(acc, (str, int, type(None))) or not isinstance(shop, (str, type(None))):
+            result["rejected"] += 1; continue
+        oid = str(oid).strip()
+        try: proc = SERVICE.resolve_processor(str(acc) if acc not in (None, "") else None, shop) if oid else None
+        except Exception as e: SYS_LOG.error(f"Webhook: bỏ đơn {oid}: {e}", key="webhook"); proc = None
+        if not proc: result["rejected"] += 1; continue
+        if not DB.claim_order(oid, proc.id): result["duplicate"] += 1; continue
+        grouped[proc].append(order)
+        result["accepted"] += 1
+    for proc, items in grouped.items(): proc.ingest_orders(global_chat_id, items)
+    ROUTER.flush()
+    return {"status": "ok", **result}
 
 @app.get("/", response_class=HTMLResponse)
 def root(authorized: bool = Depends(verify_session)): return HTML_DASHBOARD
 
 @app.get("/api/config")
 def get_config(authorized: bool = Depends(verify_session)):
-    raw_accounts = DB.get_all_accounts()
-    formatted_accounts = []
-    for acc in raw_accounts:
-        acc_dict = dict(acc)
-        acc_dict['account_name'] = acc_dict['name']
-        formatted_accounts.append(acc_dict)
-
+    # Danh sách shop lấy qua /api/accounts (phân trang), không trả curl/cookie ở đây
     return {
         "global_chat_id": DB.get_setting("global_chat_id", ""),
         "poll_interval": int(DB.get_setting("poll_interval", "10")),
@@ -447,36 +1343,78 @@ def get_config(authorized: bool = Depends(verify_session)):
             "url": DB.get_setting("pinger_url", ""),
             "interval": int(DB.get_setting("pinger_interval", "300"))
         },
-        "accounts": formatted_accounts
+        "account_count": DB.count_accounts()
     }
 
+def _apply_settings(data):
+    pinger = data.get("pinger", {})
+    DB.set_settings({
+        "global_chat_id": data.get("global_chat_id", ""),
+        "poll_interval": data.get("poll_interval", 10),
+        "pinger_enabled": "1" if pinger.get("enabled") else "0",
+        "pinger_url": pinger.get("url", ""),
+        "pinger_interval": pinger.get("interval", 300),
+    })
+
+def _apply_config(data):
+    # Toàn bộ phần chạm DB / disk / SERVICE.lock, chạy trong threadpool để không chặn event loop
+    _apply_settings(data)
+    # "accounts" chỉ có khi client gửi toàn bộ danh sách (đồng bộ kiểu cũ); UI mới lưu từng shop qua /api/accounts/{id}
+    if "accounts" in data:
+        DB.replace_accounts(data.get("accounts") or {})
+        SERVICE.reload_processors()
+    BackupManager.auto_backup_to_disk(BackupManager.create_backup_data(clean_curl=False))
+
+def _apply_restore(data):
+    _apply_settings(data)
+    accounts = data.get("accounts", {})
+    DB.replace_accounts(accounts)
+    SERVICE.reload_processors()
+    return len(accounts)
+
 @app.post("/api/config")
 async def save_config(req: Request, authorized: bool = Depends(verify_session)):
     data = await req.json()
-    global_chat_id = data.get("global_chat_id", "")
-    DB.set_setting("global_chat_id", global_chat_id)
-    DB.set_setting("poll_interval", str(data.get("poll_interval", 10)))
-    pinger = data.get("pinger", {})
-    DB.set_setting("pinger_enabled", "1" if pinger.get("enabled") else "0")
-    DB.set_setting("pinger_url", pinger.get("url", ""))
-    DB.set_setting("pinger_interval", str(pinger.get("interval", 300)))
-    
-    incoming_accs = data.get("accounts", {})
-    current_ids = {a['id'] for a in DB.get_all_accounts()}
-    incoming_ids = set(incoming_accs.keys())
-    for aid in current_ids:
-        if aid not in incoming_ids: DB.delete_account(aid)
-    for aid, adata in incoming_accs.items():
-        DB.save_account(aid, adata)
-    
-    SERVICE.reload_processors()
-    
-    full_data = BackupManager.create_backup_data(clean_curl=False) 
-    BackupManager.auto_backup_to_disk(full_data)
-    threading.Thread(target=SERVICE.broadcast_config_success, args=(global_chat_id,)).start()
-    
+    await run_in_threadpool(_apply_config, data)
+    threading.Thread(target=SERVICE.broadcast_config_success, args=(data.get("global_chat_id", ""),)).start()
     return {"status": "success"}
 
+@app.get("/api/accounts")
+def list_accounts(q: str = "", offset: int = 0, limit: int = 50, authorized: bool = Depends(verify_session)):
+    offset, limit = max(0, offset), max(1, min(limit, 200))
+    total, rows = DB.list_accounts(q.strip(), offset, limit)
+    with SERVICE.lock: procs = dict(SERVICE.processors)
+    for row in rows:
+        for k in ("has_notify", "has_chat", "has_token"): row[k] = bool(row[k])
+        row["account_name"] = row["name"]
+        proc = procs.get(row["id"])
+        row["status"] = proc.status() if proc else None
+    return {"total": total, "offset": offset, "limit": limit, "items": rows}
+
+@app.get("/api/accounts/{acc_id}")
+def get_account(acc_id: str, authorized: bool = Depends(verify_session)):
+    acc = DB.get_account(acc_id)
+    if not acc: raise HTTPException(status_code=404, detail="Không tìm thấy shop")
+    acc["account_name"] = acc["name"]
+    with SERVICE.lock: proc = SERVICE.processors.get(acc_id)
+    acc["status"] = proc.status() if proc else None
+    return acc
+
+@app.put("/api/accounts/{acc_id}")
+def put_account(acc_id: str, payload: dict = Body(...), authorized: bool = Depends(verify_session)):
+    data = {k: str(payload.get(k) or "") for k in ("account_name", "bot_token", "notify_curl", "chat_curl", "chat_id", "mute_window")}
+    DB.save_account(acc_id, data)
+    SERVICE.reload_processors()
+    BackupManager.auto_backup_to_disk(BackupManager.create_backup_data(clean_curl=False))
+    return {"status": "success", "id": acc_id}
+
+@app.delete("/api/accounts/{acc_id}")
+def delete_account(acc_id: str, authorized: bool = Depends(verify_session)):
+    DB.delete_account(acc_id)
+    SERVICE.reload_processors()
+    BackupManager.auto_backup_to_disk(BackupManager.create_backup_data(clean_curl=False))
+    return {"status": "success", "id": acc_id}
+
 @app.get("/api/stats")
 def get_stats(authorized: bool = Depends(verify_session)):
     # --- LOGIC 30 DAYS STATS ---
@@ -525,6 +1463,102 @@ def get_stats(authorized: bool = Depends(verify_session)):
         }
     }
 
+@app.get("/api/upstream")
+def get_upstream_stats(authorized: bool = Depends(verify_session)):
+    with SERVICE.lock: procs = list(SERVICE.processors.values())
+    return {"router": dict(ROUTER.stats), "shops": {p.id: {"name": p.name, **p.http.snapshot()} for p in procs}}
+
+@app.get("/api/events")
+def get_events(start: Optional[str] = None, end: Optional[str] = None, account_id: Optional[str] = None,
+               granularity: str = "raw", limit: int = 5000, authorized: bool = Depends(verify_session)):
+    # start/end: "YYYY-MM-DD" hoặc "YYYY-MM-DD HH:MM" (giờ VN). Mặc định: hôm nay. end dạng ngày được tính trọn ngày.
+    def to_ts(val, fallback, whole_day=0):
+        if not val: return int(fallback.timestamp())
+        fmt = "%Y-%m-%d %H:%M" if " " in val else "%Y-%m-%d"
+        try: ts = int(datetime.strptime(val, fmt).replace(tzinfo=VN_TZ).timestamp())
+        except ValueError: raise HTTPException(status_code=400, detail=f"Sai định dạng thời gian: {val}")
+        return ts + (whole_day if " " not in val else 0)
+    spans = {"raw": 0, "hour": 3600, "day": 86400}
+    if granularity not in spans: raise HTTPException(status_code=400, detail="granularity: raw | hour | day")
+    day_start = get_vn_time().replace(hour=0, minute=0, second=0, microsecond=0)
+    start_ts = to_ts(start, day_start)
+    end_ts = to_ts(end, day_start + timedelta(days=1), 86400)
+    return {"granularity": granularity, "events": EVENTS.query(start_ts, end_ts, account_id, spans[granularity], max(1, min(limit, 50000)))}
+
+@app.get("/api/log-level")
+def get_log_level(authorized: bool = Depends(verify_session)): return SYS_LOG.status()
+
+@app.post("/api/log-level")
+def set_log_level(payload: dict = Body(...), authorized: bool = Depends(verify_session)):
+    try: SYS_LOG.set_level(payload.get("level", ""))
+    except ValueError as e: raise HTTPException(status_code=400, detail=str(e))
+    return SYS_LOG.status()
+
+@app.get("/api/jobs")
+def get_jobs(authorized: bool = Depends(verify_session)): return {"jobs": SCHEDULER.snapshot()}
+
+@app.post("/api/jobs/{name}/run")
+def run_job(name: str, authorized: bool = Depends(verify_session)):
+    status = SCHEDULER.run_now(name)
+    if status is None: raise HTTPException(status_code=404, detail="Không có job này")
+    return {"status": status, "job": name}
+
+@app.get("/api/debug/profile", response_class=PlainTextResponse)
+def debug_profile(seconds: float = 10, hz: int = 100, authorized: bool = Depends(verify_session)):
+    try: stacks = DIAG.profile(seconds, hz)
+    except RuntimeError as e: raise HTTPException(status_code=409, detail=str(e))
+    filename = f"profile_{get_vn_time().strftime('%Y%m%d_%H%M%S')}.collapsed"
+    return PlainTextResponse(stacks, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.get("/api/debug/memory")
+def debug_memory(authorized: bool = Depends(verify_session)):
+    return {"tracing": tracemalloc.is_tracing(), "snapshots": DIAG.list_snapshots(), "app": DIAG.app_memory()}
+
+@app.post("/api/debug/memory/snapshot")
+def debug_memory_snapshot(frames: int = 10, limit: int = 20, authorized: bool = Depends(verify_session)):
+    return DIAG.take_snapshot(frames, max(1, min(limit, 200)))
+
+@app.get("/api/debug/memory/diff")
+def debug_memory_diff(base: int, target: int, limit: int = 30, authorized: bool = Depends(verify_session)):
+    try: return DIAG.diff(base, target, max(1, min(limit, 200)))
+    except KeyError as e: raise HTTPException(status_code=404, detail=e.args[0])
+
+@app.post("/api/debug/memory/stop")
+def debug_memory_stop(authorized: bool = Depends(verify_session)):
+    DIAG.stop_tracing()
+    return {"tracing": False}
+
+def _export_response(rows, columns, fmt, name):
+    if fmt not in ("csv", "ndjson"): raise HTTPException(status_code=400, detail="format: csv | ndjson")
+    filename = f"{name}_{get_vn_time().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+    media = "text/csv; charset=utf-8" if fmt == "csv" else "application/x-ndjson"
+    return StreamingResponse(DataExporter.encode(rows, columns, fmt), media_type=media, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+def _parse_export_range(start, end):
+    try:
+        start_d = datetime.strptime(start, "%Y-%m-%d") if start else datetime(2000, 1, 1)
+        end_d = datetime.strptime(end, "%Y-%m-%d") if end else get_vn_time().replace(tzinfo=None)
+    except ValueError: raise HTTPException(status_code=400, detail="start/end dạng YYYY-MM-DD")
+    return start_d.replace(tzinfo=VN_TZ), end_d.replace(tzinfo=VN_TZ)
+
+@app.get("/api/export/stats")
+def export_stats(format: str = "csv", start: Optional[str] = None, end: Optional[str] = None, account_id: Optional[str] = None,
+                 authorized: bool = Depends(verify_session)):
+    # account_id: 1 id hoặc nhiều id cách nhau dấu phẩy; end tính trọn ngày
+    start_d, end_d = _parse_export_range(start, end)
+    ids = [a.strip() for a in (account_id or "").split(",") if a.strip()]
+    rows = DataExporter.stats_rows(start_d.strftime("%Y-%m-%d"), end_d.strftime("%Y-%m-%d"), ids)
+    return _export_response(rows, DataExporter.STATS_COLUMNS, format, "galaxy_stats")
+
+@app.get("/api/export/activity")
+def export_activity(format: str = "csv", start: Optional[str] = None, end: Optional[str] = None, account_id: Optional[str] = None,
+                    authorized: bool = Depends(verify_session)):
+    start_d, end_d = _parse_export_range(start, end)
+    start_ts = int(start_d.replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+    end_ts = int(end_d.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()) + 86400
+    ids = [a.strip() for a in (account_id or "").split(",") if a.strip()]
+    return _export_response(DataExporter.activity_rows(start_ts, end_ts, ids), DataExporter.ACTIVITY_COLUMNS, format, "galaxy_activity")
+
 @app.get("/api/backup/download")
 def download_backup(authorized: bool = Depends(verify_session)):
     data = BackupManager.create_backup_data(clean_curl=True)
@@ -538,18 +1572,8 @@ async def restore_backup(file: UploadFile = File(...), authorized: bool = Depend
     try:
         content = await file.read()
         data = json.loads(content)
-        DB.set_setting("global_chat_id", data.get("global_chat_id", ""))
-        DB.set_setting("poll_interval", str(data.get("poll_interval", 10)))
-        pinger = data.get("pinger", {})
-        DB.set_setting("pinger_enabled", "1" if pinger.get("enabled") else "0")
-        DB.set_setting("pinger_url", pinger.get("url", ""))
-        DB.set_setting("pinger_interval", str(pinger.get("interval", 300)))
-        accounts = data.get("accounts", {})
-        all_old = DB.get_all_accounts()
-        for old in all_old: DB.delete_account(old['id'])
-        for aid, acc_data in accounts.items(): DB.save_account(aid, acc_data)
-        SERVICE.reload_processors()
-        return {"status": "success", "message": f"Đã khôi phục {len(accounts)} shop thành công!"}
+        count = await run_in_threadpool(_apply_restore, data)
+        return {"status": "success", "message": f"Đã khôi phục {count} shop thành công!"}
     except Exception as e: return JSONResponse(status_code=400, content={"status": "error", "message": str(e)})
 
 # ==============================================================================
@@ -641,8 +1665,14 @@ HTML_DASHBOARD = f"""
         .btn-blue {{ background: linear-gradient(90deg, var(--neon-cyan), #0066ff); }}
         .btn-purple {{ background: linear-gradient(90deg, #bc13fe, #ff0055); }}
 
-        /* SHOP LIST (ACCORDION) */
-        .shop-list-header {{ display: flex; justify-content: space-between; align-items: center; background: #111; padding: 15px 20px; border-radius: 8px; margin-bottom: 30px; border: 1px solid var(--border); }}
+        /* SHOP LIST (VIRTUAL LIST + EDITOR) */
+        .shop-list-header {{ display: flex; justify-content: space-between; align-items: center; gap: 15px; background: #111; padding: 15px 20px; border-radius: 8px; margin-bottom: 15px; border: 1px solid var(--border); }}
+        .shop-list-header input {{ max-width: 320px; }}
+        .shop-viewport {{ position: relative; height: 480px; overflow-y: auto; border: 1px solid var(--border); border-radius: 8px; margin-bottom: 20px; background: rgba(20, 0, 40, 0.2); }}
+        .shop-row {{ position: absolute; left: 0; right: 0; height: 56px; display: flex; justify-content: space-between; align-items: center; padding: 0 20px; border-bottom: 1px solid rgba(188, 19, 254, 0.2); cursor: pointer; }}
+        .shop-row:hover {{ background: rgba(188, 19, 254, 0.08); }}
+        .shop-meta {{ color: #aaa; font-size: 0.85rem; margin-left: 15px; }}
+        .shop-empty {{ padding: 20px; color: #aaa; text-align: center; }}
         
         .shop-item {{ margin-bottom: 15px; border: 1px solid var(--neon-purple); border-radius: 8px; background: rgba(20, 0, 40, 0.3); overflow: hidden; transition: 0.3s; }}
         .shop-item:hover {{ box-shadow: 0 0 15px rgba(188, 19, 254, 0.2); }}
@@ -732,6 +1762,7 @@ HTML_DASHBOARD = f"""
                     </div>
                     <div style="display:flex; gap:15px;">
                         <a href="/api/backup/download" target="_blank" class="btn-act btn-blue">⬇️ TẢI BACKUP JSON</a>
+                        <a href="/api/export/stats?format=csv" target="_blank" class="btn-act btn-blue">📊 XUẤT THỐNG KÊ CSV</a>
                         
                         <input type="file" id="restoreFile" style="display:none;" accept=".json" onchange="doRestore(this)">
                         <label for="restoreFile" class="btn-act btn-purple">⬆️ RESTORE FILE</label>
@@ -741,13 +1772,38 @@ HTML_DASHBOARD = f"""
 
             <div class="shop-list-header">
                 <div style="font-family:'Orbitron'; font-size:1.2rem;">🚀 DANH SÁCH SHOP</div>
+                <input type="text" id="acc_search" placeholder="🔍 Tìm shop..." oninput="searchAccounts(this.value)">
                 <button type="button" class="btn-act btn-blue" onclick="addAccount()">+ THÊM SHOP</button>
             </div>
             
-            <div id="acc_list"></div>
+            <div id="acc_list" class="shop-viewport" onscroll="renderRows()"><div id="acc_spacer"></div></div>
+
+            <div id="acc_editor" class="shop-item active" style="display:none;">
+                <div class="shop-header">
+                    <div class="shop-name">SHOP: <span id="ed_title">Mới</span></div>
+                    <div>
+                        <button type="button" class="btn-del" onclick="deleteAccount()">XOÁ</button>
+                        <button type="button" class="btn-del" style="border-color:#aaa; color:#aaa;" onclick="closeEditor()">ĐÓNG</button>
+                    </div>
+                </div>
+                <div class="shop-body">
+                    <div class="form-row">
+                        <div class="form-group"><label>TÊN SHOP:</label><input type="text" id="ed_name" oninput="document.getElementById('ed_title').innerText=this.value"></div>
+                        <div class="form-group"><label>TOKEN:</label><input type="password" id="ed_token"></div>
+                    </div>
+                    <div class="form-row">
+                        <div class="form-group"><label>CHAT ID RIÊNG (trống = Master ID):</label><input type="text" id="ed_chatid"></div>
+                        <div class="form-group"><label>GIỜ TẮT THÔNG BÁO (vd 23:00-07:00):</label><input type="text" id="ed_mute"></div>
+                    </div>
+                    <div id="ed_cookie" class="shop-meta" style="margin: 0 0 10px 0;"></div>
+                    <div class="form-group"><label>NOTIFY CURL:</label><textarea id="ed_notify" rows="2"></textarea></div>
+                    <div class="form-group"><label>CHAT CURL:</label><textarea id="ed_chat" rows="2"></textarea></div>
+                    <button type="button" class="btn-act btn-purple" style="margin-top:15px;" onclick="saveAccount()">💾 LƯU SHOP</button>
+                </div>
+            </div>
 
             <div class="action-bar">
-                <button type="submit" class="btn-save">LƯU TẤT CẢ CẤU HÌNH</button>
+                <button type="submit" class="btn-save">LƯU CẤU HÌNH CHUNG</button>
             </div>
         </form>
     </div>
@@ -815,32 +1871,119 @@ HTML_DASHBOARD = f"""
             setTimeout(()=>t.classList.remove('show'), 3000);
         }}
 
-        function toggleAcc(header) {{
-            header.parentElement.classList.toggle('active');
+        // --- SHOP LIST: tải theo trang + chỉ render các dòng đang nhìn thấy ---
+        const ROW_H = 56, PAGE = 100;
+        const accState = {{ items: [], total: 0, q: '', loading: false, seq: 0 }};
+        let editingId = null, searchTimer = null;
+        const esc = (v) => String(v ?? '').replace(/[&<>"']/g, c => ({{'&':'&amp;','<':'&lt;','>':'&gt;','"':'&quot;',"'":'&#39;'}}[c]));
+
+        function fmtAge(s) {{
+            if(s == null) return '?';
+            if(s < 3600) return Math.max(1, Math.round(s/60)) + 'p';
+            if(s < 86400) return Math.round(s/3600) + 'h';
+            return Math.round(s/86400) + 'd';
         }}
 
-        function renderAccount(id, d={{}}) {{
-            const div = document.createElement('div'); div.className = 'shop-item'; div.dataset.id = id;
-            div.innerHTML = `
-                <div class="shop-header" onclick="toggleAcc(this)">
-                    <div class="shop-name">SHOP: ${{d.account_name||'Mới'}}</div>
-                    <button type="button" class="btn-del" onclick="event.stopPropagation(); this.closest('.shop-item').remove(); updateCount()">XOÁ</button>
-                </div>
-                <div class="shop-body">
-                    <div class="form-row">
-                        <div class="form-group"><label>TÊN SHOP:</label><input type="text" class="acc-name" value="${{d.account_name||''}}" oninput="this.closest('.shop-item').querySelector('.shop-name').innerText='SHOP: '+this.value"></div>
-                        <div class="form-group"><label>TOKEN:</label><input type="password" class="acc-token" value="${{d.bot_token||''}}"></div>
-                    </div>
-                    <div class="form-group"><label>NOTIFY CURL:</label><textarea class="acc-notify" rows="2">${{d.notify_curl||''}}</textarea></div>
-                    <div class="form-group"><label>CHAT CURL:</label><textarea class="acc-chat" rows="2">${{d.chat_curl||''}}</textarea></div>
-                </div>
-            `;
-            document.getElementById('acc_list').appendChild(div);
-            updateCount();
+        function statusText(a) {{
+            const st = a.status;
+            if(!st) return '⏸️ Chưa chạy';
+            if(st.cookie_expired) return '⚠️ Cookie hết hạn';
+            const parts = [st.push_mode ? '📡 Push' : '🟢 OK'];
+            if(st.cookie && st.cookie.count) parts.push('🍪 ' + fmtAge(st.cookie.age_s) + (st.cookie.refreshed ? ' ♻️' : '') + (st.cookie.next_expiry_s != null ? ' · hết hạn ' + (st.cookie.next_expiry_s > 0 ? 'sau ' + fmtAge(st.cookie.next_expiry_s) : 'rồi') : ''));
+            if(st.counters && st.counters.length) parts.push('📦 ' + (st.counters[0]||0) + ' · ✉️ ' + (st.counters[8]||0));
+            if(st.failures) parts.push('❌ ' + st.failures + ' lỗi');
+            if(st.p95_ms) parts.push('p95 ' + st.p95_ms + 'ms');
+            return parts.join(' · ');
+        }}
+
+        async function loadAccounts(reset=false) {{
+            if(reset) {{ accState.items = []; accState.total = 0; accState.seq++; document.getElementById('acc_list').scrollTop = 0; }}
+            if(accState.loading && !reset) return;
+            const seq = accState.seq;
+            accState.loading = true;
+            try {{
+                const r = await (await fetch(`/api/accounts?q=${{encodeURIComponent(accState.q)}}&offset=${{accState.items.length}}&limit=${{PAGE}}`)).json();
+                if(seq !== accState.seq) return;
+                accState.items.push(...r.items); accState.total = r.total;
+                if(!accState.q) document.getElementById('shop-count').innerText = r.total;
+            }} finally {{ if(seq === accState.seq) accState.loading = false; }}
+            renderRows();
+        }}
+
+        function renderRows() {{
+            const vp = document.getElementById('acc_list'), spacer = document.getElementById('acc_spacer');
+            spacer.style.height = (accState.items.length * ROW_H) + 'px';
+            const first = Math.max(0, Math.floor(vp.scrollTop / ROW_H) - 5);
+            const last = Math.min(accState.items.length, Math.ceil((vp.scrollTop + vp.clientHeight) / ROW_H) + 5);
+            let out = '';
+            for(let i = first; i < last; i++) {{
+                const a = accState.items[i];
+                out += `<div class="shop-row" style="top:${{i*ROW_H}}px" data-id="${{esc(a.id)}}">
+                    <div><span class="shop-name">${{esc(a.account_name||'Không tên')}}</span><span class="shop-meta">${{esc(statusText(a))}}</span></div>
+                    <span class="shop-meta">SỬA ›</span></div>`;
+            }}
+            if(!accState.items.length && !accState.loading) out = `<div class="shop-empty">Chưa có shop nào</div>`;
+            spacer.innerHTML = out;
+            if(last >= accState.items.length - 10 && accState.items.length < accState.total) loadAccounts();
+        }}
+
+        // id shop có thể chứa ký tự bất kỳ -> đọc từ data-id, không nhúng vào onclick
+        document.getElementById('acc_spacer').addEventListener('click', (e) => {{
+            const row = e.target.closest('.shop-row');
+            if(row) openEditor(row.dataset.id);
+        }});
+
+        function searchAccounts(q) {{
+            clearTimeout(searchTimer);
+            searchTimer = setTimeout(()=>{{ accState.q = q.trim(); loadAccounts(true); }}, 300);
+        }}
+
+        function fillEditor(id, d={{}}) {{
+            editingId = id;
+            document.getElementById('ed_title').innerText = d.account_name || 'Mới';
+            document.getElementById('ed_name').value = d.account_name || '';
+            document.getElementById('ed_token').value = d.bot_token || '';
+            document.getElementById('ed_chatid').value = d.chat_id || '';
+            document.getElementById('ed_mute').value = d.mute_window || '';
+            document.getElementById('ed_notify').value = d.notify_curl || '';
+            document.getElementById('ed_chat').value = d.chat_curl || '';
+            const ck = d.status && d.status.cookie;
+            document.getElementById('ed_cookie').innerText = ck && ck.count
+                ? `🍪 ${{ck.count}} cookie · cập nhật ${{fmtAge(ck.age_s)}} trước${{ck.refreshed ? ' (tự refresh từ Set-Cookie)' : ' (từ cURL)'}}${{ck.next_expiry_s != null ? ' · hết hạn ' + (ck.next_expiry_s > 0 ? 'sau ' + fmtAge(ck.next_expiry_s) : 'rồi') : ''}}`
+                : '';
+            const ed = document.getElementById('acc_editor'); ed.style.display = 'block'; ed.scrollIntoView({{behavior: 'smooth'}});
+        }}
+
+        async function openEditor(id) {{
+            const r = await fetch('/api/accounts/' + encodeURIComponent(id));
+            if(!r.ok) {{ toast('❌ Không tải được shop'); return; }}
+            fillEditor(id, await r.json());
+        }}
+
+        function addAccount() {{ fillEditor(crypto.randomUUID()); }}
+        function closeEditor() {{ editingId = null; document.getElementById('acc_editor').style.display = 'none'; }}
+
+        async function saveAccount() {{
+            if(!editingId) return;
+            const body = {{
+                account_name: document.getElementById('ed_name').value,
+                bot_token: document.getElementById('ed_token').value,
+                chat_id: document.getElementById('ed_chatid').value,
+                mute_window: document.getElementById('ed_mute').value,
+                notify_curl: document.getElementById('ed_notify').value,
+                chat_curl: document.getElementById('ed_chat').value
+            }};
+            const r = await fetch('/api/accounts/' + encodeURIComponent(editingId), {{method:'PUT',headers:{{'Content-Type':'application/json'}},body:JSON.stringify(body)}});
+            toast(r.ok ? '✅ Đã lưu shop!' : '❌ Lưu shop thất bại');
+            if(r.ok) {{ closeEditor(); loadAccounts(true); }}
         }}
 
-        function addAccount() {{ renderAccount(crypto.randomUUID()); }}
-        function updateCount() {{ document.getElementById('shop-count').innerText = document.querySelectorAll('.shop-item').length; }}
+        async function deleteAccount() {{
+            if(!editingId || !confirm('Xoá shop này?')) return;
+            const r = await fetch('/api/accounts/' + encodeURIComponent(editingId), {{method:'DELETE'}});
+            toast(r.ok ? '🗑️ Đã xoá shop' : '❌ Xoá thất bại');
+            if(r.ok) {{ closeEditor(); loadAccounts(true); }}
+        }}
 
         // CLOCK
         setInterval(()=>{{
@@ -857,8 +2000,8 @@ HTML_DASHBOARD = f"""
                 document.getElementById('p_enable').value = conf.pinger.enabled?'1':'0';
                 document.getElementById('p_url').value = conf.pinger.url;
                 document.getElementById('p_interval').value = conf.pinger.interval;
-                document.getElementById('acc_list').innerHTML='';
-                (conf.accounts||[]).forEach(a=>renderAccount(a.id, a));
+                document.getElementById('shop-count').innerText = conf.account_count;
+                await loadAccounts(true);
                 
                 const stats = await api.getStats();
                 renderChart(stats);
@@ -867,15 +2010,6 @@ HTML_DASHBOARD = f"""
 
         document.getElementById('mainForm').onsubmit = async(e) => {{
             e.preventDefault();
-            const accounts = {{}};
-            document.querySelectorAll('.shop-item').forEach(el=>{{
-                accounts[el.dataset.id] = {{
-                    account_name: el.querySelector('.acc-name').value,
-                    bot_token: el.querySelector('.acc-token').value,
-                    notify_curl: el.querySelector('.acc-notify').value,
-                    chat_curl: el.querySelector('.acc-chat').value
-                }};
-            }});
             const pl = {{
                 global_chat_id: document.getElementById('gid').value,
                 poll_interval: parseInt(document.getElementById('poll_int').value),
@@ -883,8 +2017,7 @@ HTML_DASHBOARD = f"""
                     enabled: document.getElementById('p_enable').value==='1',
                     url: document.getElementById('p_url').value,
                     interval: parseInt(document.getElementById('p_interval').value)
-                }},
-                accounts: accounts
+                }}
             }};
             toast('Đang lưu...');
             await api.saveConfig(pl);
@@ -924,8 +2057,11 @@ HTML_DASHBOARD = f"""
 # ==============================================================================
 
 if not SystemConfig.DISABLE_POLLER:
-    t1 = threading.Thread(target=SERVICE.poller_loop, daemon=True); t1.start()
-    t2 = threading.Thread(target=SERVICE.pinger_loop, daemon=True); t2.start()
+    SCHEDULER.add("poller", SERVICE.poll_tick, SystemConfig.DEFAULT_POLL_INTERVAL, jitter=0.05, first_delay=0)
+    SCHEDULER.add("pinger", SERVICE.ping, 300, jitter=0.2, first_delay=30)
+SCHEDULER.add("event-compactor", EVENTS.compact, 3600, jitter=0.2)
+SCHEDULER.add("auto-backup", lambda: BackupManager.auto_backup_to_disk(BackupManager.create_backup_data(clean_curl=False)), 86400, jitter=0.1)
+SCHEDULER.start()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,22 @@
+import importlib
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def server(tmp_path_factory):
+    # server.py tạo DB / log theo thư mục hiện tại và khởi động job nền ngay khi import;
+    # MonkeyPatch.context() trả lại cwd, env và sys.path khi hết phiên test
+    with pytest.MonkeyPatch.context() as mp:
+        mp.chdir(tmp_path_factory.mktemp("galaxy"))
+        mp.setenv("DISABLE_POLLER", "1")
+        mp.syspath_prepend(ROOT)
+        yield importlib.import_module("server")
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
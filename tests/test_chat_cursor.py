@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+
+class FakeChatResponse:
+    def __init__(self, chats):
+        self.body = json.dumps(chats).encode()
+        self.closed = False
+
+    def iter_content(self, chunk_size=8192):
+        for i in range(0, len(self.body), chunk_size): yield self.body[i:i + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def shop(server, request):
+    acc_id = request.node.name
+    proc = server.AccountProcessor({"id": acc_id, "name": acc_id, "bot_token": "", "notify_curl": "", "chat_curl": "curl 'https://taphoa.test/chats'"})
+    proc.upstream = []  # mới nhất đứng đầu, giống upstream
+    proc.make_request = lambda config, deadline=None, stream=False: FakeChatResponse(proc.upstream[:50])
+    return proc
+
+
+def chat(n):
+    return {"guest_user": f"g{n}", "last_chat": f"hi {n}", "date": 1000 + n}
+
+
+def test_cursor_advances_when_limit_is_hit_on_the_last_new_chat(shop):
+    shop.upstream = [chat(n) for n in range(3, 0, -1)]
+    shop.fetch_chats(is_baseline=True)
+    assert shop.chat_sorted and shop.chat_cursor == 1003
+    for n in range(4, 1015):
+        shop.upstream.insert(0, chat(n))
+        assert len(shop.fetch_chats(limit=1)) == 1
+        assert shop.chat_cursor == 1000 + n
+    # seen set đã tràn 1000 phần tử; cursor vẫn chặn hội thoại cũ bị báo lại
+    assert shop.fetch_chats(limit=3) == []
+
+
+def test_cursor_holds_while_new_chats_remain_below_the_limit(shop):
+    shop.upstream = [chat(n) for n in range(3, 0, -1)]
+    shop.fetch_chats(is_baseline=True)
+    shop.upstream = [chat(n) for n in range(6, 0, -1)]
+    first = shop.fetch_chats(limit=1)
+    assert len(first) == 1 and "g6" in first[0]
+    assert shop.chat_cursor == 1003
+    rest = shop.fetch_chats(limit=5)
+    assert [m for m in rest if "g5" in m] and [m for m in rest if "g4" in m] and len(rest) == 2
+    assert shop.chat_cursor == 1006
@@ -0,0 +1,29 @@
+import time
+
+
+def account(cookie):
+    return {"id": "ck-shop", "name": "ck", "bot_token": "", "notify_curl": "", "chat_curl": f"curl 'https://taphoa.test/chats' -b '{cookie}'"}
+
+
+def test_reload_keeps_the_live_jar_when_the_seed_is_unchanged(server, monkeypatch):
+    old = server.AccountProcessor(account("sid=seed"))
+    monkeypatch.setattr(server.SERVICE, "processors", {old.id: old})
+    monkeypatch.setattr(server.DB, "get_all_accounts", lambda: [account("sid=seed")])
+    old.cookies.cookies["sid"] = {"value": "rolled", "expires": None}  # Set-Cookie tới sau khi processor mới đã đọc DB
+    server.SERVICE.reload_processors()
+    assert server.SERVICE.processors[old.id].cookies is old.cookies
+    assert server.SERVICE.processors[old.id].cookies.header() == "sid=rolled"
+
+    monkeypatch.setattr(server.DB, "get_all_accounts", lambda: [account("sid=pasted")])
+    server.SERVICE.reload_processors()
+    assert server.SERVICE.processors[old.id].cookies.header() == "sid=pasted"
+
+
+def test_expired_cookies_do_not_pin_next_expiry(server):
+    jar = server.AccountProcessor(account("sid=seed")).cookies
+    now = time.time()
+    jar.cookies["trk"] = {"value": "1", "expires": now - 5}
+    jar.cookies["csrf"] = {"value": "2", "expires": now + 600}
+    summary = jar.summary()
+    assert summary["count"] == 2 and 590 <= summary["next_expiry_s"] <= 600
+    assert "trk" not in jar.cookies
@@ -0,0 +1,47 @@
+import time
+
+
+class FakeResponse:
+    def __init__(self, status_code, chunks=(), delay=0.0):
+        self.status_code, self.chunks, self.delay, self.closed = status_code, chunks, delay, False
+
+    def iter_content(self, chunk_size=8192):
+        for chunk in self.chunks:
+            time.sleep(self.delay)
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+def test_stalled_shops_share_one_tick_budget(server, monkeypatch):
+    monkeypatch.setattr(server.SystemConfig, "TICK_BUDGET", 0.3)
+    monkeypatch.setattr(server.SystemConfig, "SHOP_BUDGET", 0.2)
+    start = time.monotonic()
+    polled = []
+    for proc, deadline in server.SERVICE.shop_deadlines(["a", "b", "c", "d", "e"]):
+        assert deadline.remaining() <= 0.2
+        time.sleep(max(0.0, deadline.remaining()))  # shop treo tới hết phần ngân sách của nó
+        polled.append(proc)
+    assert polled == ["a", "b"]
+    assert time.monotonic() - start < 0.45
+
+
+def test_retried_5xx_responses_are_closed(server, monkeypatch):
+    monkeypatch.setattr(server.SystemConfig, "RETRY_BACKOFF", 0.0)
+    responses = [FakeResponse(503), FakeResponse(502), FakeResponse(200)]
+    sent = iter(responses)
+    resp = server.TimeoutPolicy().execute(lambda timeout: next(sent), server.Deadline(5))
+    assert resp is responses[2] and not resp.closed
+    assert responses[0].closed and responses[1].closed
+
+
+def test_slow_chat_body_stops_at_the_deadline(server):
+    proc = server.AccountProcessor({"id": "slow-body", "name": "slow", "bot_token": "", "notify_curl": "", "chat_curl": "curl 'https://taphoa.test/chats'"})
+    body = [b"["] + [b'{"guest_user": "g", "last_chat": "x", "date": %d},' % n for n in range(50)] + [b"{}]"]
+    resp = FakeResponse(200, body, delay=0.05)
+    proc.make_request = lambda config, deadline=None, stream=False: resp
+    start = time.monotonic()
+    assert proc.fetch_chats(deadline=server.Deadline(0.2)) == []
+    assert time.monotonic() - start < 0.4
+    assert resp.closed and proc.http.snapshot()["deadline_skips"] == 1
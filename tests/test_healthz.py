@@ -0,0 +1,44 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+
+@pytest.mark.anyio
+async def test_healthz_stays_fast_during_large_config_save(server, monkeypatch):
+    slow_reload = 1.0
+    real_reload = server.SERVICE.reload_processors
+
+    def slow_reload_processors():
+        time.sleep(slow_reload)  # giả lập reload nặng (nhiều shop, giữ SERVICE.lock)
+        real_reload()
+
+    monkeypatch.setattr(server.SERVICE, "reload_processors", slow_reload_processors)
+    accounts = {f"shop-{i}": {"account_name": f"Shop {i}", "bot_token": "", "notify_curl": "", "chat_curl": ""} for i in range(500)}
+    payload = {"global_chat_id": "", "poll_interval": 10, "pinger": {}, "accounts": accounts}
+
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", cookies={"session_id": "admin_authorized"}) as client:
+        async def timed_health(delay):
+            # Tính từ lúc lên lịch: nếu event loop bị chặn thì cả sleep lẫn request đều trễ
+            start = time.perf_counter()
+            await asyncio.sleep(delay)
+            resp = await client.get("/healthz")
+            assert resp.status_code == 200
+            return time.perf_counter() - start - delay
+
+        save_start = time.perf_counter()
+        save_task = asyncio.create_task(client.post("/api/config", json=payload))
+        latencies = []
+        while not save_task.done():
+            latencies.append(await timed_health(0.05))
+        save_resp = await save_task
+        save_elapsed = time.perf_counter() - save_start
+
+    assert save_resp.status_code == 200
+    assert save_elapsed >= slow_reload
+    assert len(latencies) >= 5, latencies
+    assert max(latencies) < 0.2, latencies
+    assert server.DB.count_accounts() == 500
+
@@ -0,0 +1,21 @@
+class Shop:
+    def __init__(self, acc_id):
+        self.id, self.name, self.bot_token, self.chat_id, self.mute_window = acc_id, acc_id, "tok", "42", ""
+
+
+def test_alert_is_sent_mid_tick_once_it_has_waited_flush_after(server, monkeypatch):
+    shops = [Shop(f"r{i}") for i in range(4)]
+    sent = []
+    router = server.NotificationRouter()
+    monkeypatch.setattr(router, "post", lambda bot_token, chat_id, text: sent.append(text) or True)
+
+    router.submit(shops[0], "", "alert r0")
+    router.flush_due()
+    assert sent == []  # còn trong cửa sổ gom
+    router.submit(shops[1], "", "alert r1")
+    router.oldest_at -= router.FLUSH_AFTER  # alert r0 đã chờ đủ lâu
+    router.flush_due()
+    assert sent == ["alert r0\n\nalert r1"]
+    router.submit(shops[2], "", "alert r2")
+    router.flush_due()
+    assert len(sent) == 1 and len(router.pending) == 1
@@ -0,0 +1,30 @@
+import threading
+import time
+
+
+def wait_until(cond, timeout=3.0):
+    end = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < end
+        time.sleep(0.01)
+
+
+def test_run_now_on_a_running_job_queues_a_follow_up_run(server):
+    scheduler = server.JobScheduler(workers=1)
+    started, release, runs = threading.Event(), threading.Event(), []
+
+    def job():
+        runs.append(time.monotonic())
+        started.set()
+        release.wait(3)
+
+    scheduler.add("slow", job, interval=3600, first_delay=0)
+    scheduler.start()
+    assert started.wait(3)
+    assert scheduler.run_now("slow") == "queued"
+    assert scheduler.run_now("missing") is None
+    release.set()
+    wait_until(lambda: len(runs) == 2)
+    assert scheduler.snapshot()[0]["skipped_overlap"] == 0
+    wait_until(lambda: not scheduler.snapshot()[0]["running"])
+    assert scheduler.run_now("slow") == "scheduled"
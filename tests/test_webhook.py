@@ -0,0 +1,28 @@
+import httpx
+import pytest
+
+
+class RecordingShop:
+    def __init__(self, acc_id, name):
+        self.id, self.name, self.ingested = acc_id, name, []
+
+    def ingest_orders(self, global_chat_id, orders):
+        self.ingested.extend(o["order_id"] for o in orders)
+
+
+@pytest.mark.anyio
+async def test_malformed_order_does_not_lose_the_rest_of_the_batch(server, monkeypatch):
+    shop = RecordingShop("wh-shop", "Demo")
+    monkeypatch.setattr(server.SystemConfig, "WEBHOOK_SECRET", "s3cret")
+    monkeypatch.setattr(server.SERVICE, "processors", {shop.id: shop, "other": RecordingShop("other", "Khác")})
+    batch = [{"order_id": "WH1", "shop": "Demo"}, {"order_id": "WH2", "shop": 5}, {"order_id": {"x": 1}, "shop": "Demo"}, "oops", {"order_id": 7, "shop": "demo"}]
+
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", headers={"X-Auth-Secret": "s3cret"}) as client:
+        first = await client.post("/taphoammo", json=batch)
+        retry = await client.post("/taphoammo", json=batch)
+
+    assert first.status_code == 200
+    assert first.json() == {"status": "ok", "accepted": 2, "duplicate": 0, "rejected": 3}
+    assert retry.json() == {"status": "ok", "accepted": 0, "duplicate": 2, "rejected": 3}
+    assert shop.ingested == ["WH1", 7]